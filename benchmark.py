@@ -0,0 +1,421 @@
+#!/usr/bin/env python2
+
+#
+# Benchmark build_tools.py on a generated working area, so a change can be measured
+# without a real (multi-hour) tools build.
+#
+# For each tree size a root is generated holding:
+#   remotes/  bare git repos standing in for the container repos and infr_scripts_pl,
+#             with a Jenkinsfile per container copying the tarballs of the
+#             containers it depends on (as in all_containers) and an Upload stage
+#             creating its own (as in container_exports)
+#   bin/      a stub Build.pl writing a configurable number and size of files per
+#             domain into Installs
+#   jenkins/  the tarballs of every container, served by a local HTTP server in
+#             place of Jenkins
+#
+# build_tools.py is then run (with --timing) to clone and download a working area,
+# build it, rebuild it from the cache and incrementally rebuild after a source
+# change. The wall time of each run and its phases (clone, download, extract,
+# import, Build.pl, export, package, ...) are saved as JSON, and can be compared
+# with a previous run to find regressions.
+#
+
+import argparse
+import BaseHTTPServer
+import collections
+import imp
+import json
+import os
+import platform
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+
+BUILD_TOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "build_tools.py")
+
+#
+# Tree sizes: (containers, files per domain, file size). The containers must include
+# those they depend on. None is all of all_containers.
+#
+sizes = collections.OrderedDict([
+  # Name      # Containers, Files, Bytes
+  ("small"  , (("tools_common", "ar", "xas", "xmap"), 50, 8 * 1024)),
+  ("medium" , (("xcommon", "tools_common", "ar", "tools_xpp", "xc_compiler_combined", "xas", "xmap", "xobjdump",
+                "xcc_driver", "xsim_combined"), 200, 16 * 1024)),
+  ("large"  , (None, 1000, 32 * 1024)),
+])
+
+#
+# The build_tools.py runs timed for each size, as (name, build_tools.py args).
+# {containers} is replaced by the containers in the tree, and {changed} by the one
+# the most others depend on, which has a source change before the incremental run.
+#
+runs = [
+  ("unpack",      ["--mkroot", "--clone", "{containers}"]),
+  ("update",      ["--clone", "--update", "{containers}"]),
+  ("build",       ["-j", "{jobs}", "{containers}"]),
+  ("rebuild",     ["-j", "{jobs}", "{containers}"]),
+  ("incremental", ["-j", "{jobs}", "--incremental", "--affected-by", "{changed}"]),
+]
+
+#
+# Stub Build.pl: writes BENCH_FILES files of BENCH_FILE_SIZE bytes for each domain
+# in DOMAINS= into Installs/Linux/External (exported) and Installs/Linux/private.
+# The content is half pseudo-random and half text so it compresses like binaries,
+# and depends on the domain's src.txt so a source change changes the output.
+#
+STUB_BUILD_PL = r'''#!%(python)s
+import hashlib, os, sys, time
+files = int(os.environ.get("BENCH_FILES", "10"))
+size = int(os.environ.get("BENCH_FILE_SIZE", "1024"))
+time.sleep(float(os.environ.get("BENCH_SLEEP", "0")))
+domains = []
+for a in sys.argv[1:]:
+    if a.startswith("DOMAINS="):
+        domains = [d for d in a[len("DOMAINS="):].split(",") if d]
+name = os.path.basename(os.getcwd())
+for d in domains:
+    try:
+        rev = open(os.path.join(d, "src.txt")).read()
+    except IOError:
+        rev = ""
+    seed = "%%s %%s %%s" %% (name, d, rev)
+    pool = "".join([hashlib.sha512("%%s %%d" %% (seed, i)).digest() for i in range(size // 128 + 1)])
+    for sub, count in (("External/Product/lib/" + d, files), ("private/" + d, max(1, files // 10))):
+        out = os.path.join("Installs", "Linux", sub)
+        if not os.path.isdir(out):
+            os.makedirs(out)
+        for i in range(count):
+            text = ("%%s file %%d " %% (seed, i)) * (size // 40 + 1)
+            with open(os.path.join(out, "f%%d" %% (i,)), "wb") as f:
+                f.write(pool[(i * 64) %% (size // 2):][:size // 2] + text[:size - size // 2])
+print "stub Build.pl built %%s in %%s" %% (",".join(domains), name)
+'''
+
+#
+# The build_tools.py tables (importing it runs nothing)
+#
+def BuildToolsTables():
+    return vars(imp.load_source("build_tools", BUILD_TOOLS))
+
+def Git(cmd, cwd):
+    subprocess.check_call(["git", "-c", "user.email=bench@example.com", "-c", "user.name=bench"] + cmd, cwd=cwd,
+                          stdout=open(os.devnull, "w"))
+
+#
+# Make a git repo of "files" ({path : content}) in "src", and a bare clone of it as "remote"
+#
+def MakeRepo(src, remote, files):
+    for path, content in files.items():
+        path = os.path.join(src, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+    Git(["init", "-q"], src)
+    Git(["add", "-A"], src)
+    Git(["commit", "-q", "-m", "Benchmark"], src)
+    Git(["clone", "-q", "--bare", src, remote], None)
+
+def Domains(t, container):
+    if container in t["build_domains"]:
+        return t["build_domains"][container].split(",")
+    info = t["container_mapping_info"].get(container)
+    if info and info.get("flat_structure"):
+        return [info["domain"]]
+    return ["%s_a" % (container,), "%s_b" % (container,)]
+
+def Tarballs(t, container):
+    return [e % ("Linux64", "tgz") for e in t["container_exports"].get(container, ())]
+
+def Jenkinsfile(t, container):
+    imports = []
+    for dep in t["all_containers"][container]:
+        tarballs = Tarballs(t, dep)
+        # A * is taken to be both the Installs and private tarballs
+        if 2 == len(tarballs):
+            filter = "Linux64_%s_*.tgz" % (dep,)
+        else:
+            filter = tarballs[0]
+        imports.append("        copyArtifacts filter: '%s', projectName: 'XMOS/%s/master', selector: lastSuccessful()" % (filter, dep))
+
+    uploads = []
+    for tarball in Tarballs(t, container):
+        if -1 != tarball.find("_private."):
+            uploads.append('                sh "tar czf %s Installs/Linux/private"' % (tarball,))
+        else:
+            uploads.append('                sh "tar czf %s Installs/Linux/External"' % (tarball,))
+
+    return """pipeline {
+  stages {
+    stage("Get") {
+      steps {
+%s
+      }
+    }
+    stage("Build") {
+      parallel {
+        stage("Centos") {
+          stages {
+            stage("Upload") {
+              steps {
+%s
+                archiveArtifacts artifacts: 'Linux64_*.tgz'
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+""" % ("\n".join(imports), "\n".join(uploads))
+
+#
+# Generate the tree for "containers" under "root"
+#
+def Generate(t, root, containers, files, fileSize):
+    shutil.rmtree(root, True)
+    for d in ("remotes/int", "remotes/pub", "src", "bin", "jenkins"):
+        os.makedirs(os.path.join(root, d))
+
+    stub = os.path.join(root, "bin", "Build.pl")
+    with open(stub, "w") as f:
+        f.write(STUB_BUILD_PL % {"python" : sys.executable})
+    os.chmod(stub, 0755)
+
+    setupEnv = "export PATH=%s:$PATH\nexport BENCH_FILES=%d\nexport BENCH_FILE_SIZE=%d\n" % (os.path.join(root, "bin"), files, fileSize)
+    MakeRepo(os.path.join(root, "src", "infr_scripts_pl"), os.path.join(root, "remotes", "pub", "infr_scripts_pl"),
+             {"Build/SetupEnv" : setupEnv, "README" : "Benchmark infr_scripts_pl\n"})
+    MakeRepo(os.path.join(root, "src", "bin2header"), os.path.join(root, "remotes", "pub", "bin2header"),
+             {"README" : "Benchmark bin2header\n"})
+
+    env = dict(os.environ)
+    env.update({"BENCH_FILES" : str(files), "BENCH_FILE_SIZE" : str(fileSize)})
+
+    for c in containers:
+        domains = Domains(t, c)
+        flat = t["container_mapping_info"].get(c, {}).get("flat_structure")
+        repo = {"Jenkinsfile" : Jenkinsfile(t, c), ".gitignore" : "Installs*\n"}
+        for d in domains:
+            prefix = ""
+            if not flat:
+                prefix = d + "/"
+            repo[prefix + "Build.pl"] = "# Benchmark domain %s\n" % (d,)
+            repo[prefix + "src.txt"] = "1\n"
+        src = os.path.join(root, "src", c)
+        MakeRepo(src, os.path.join(root, "remotes", "int", c), repo)
+
+        # The tarballs Jenkins would have built, made from the stub output
+        tarballs = Tarballs(t, c)
+        if not tarballs:
+            continue
+        # The stub output depends on the directory name, so build in one named after the container
+        build = os.path.join(root, "jenkins_build", c)
+        os.makedirs(build)
+        for d in domains:
+            os.makedirs(os.path.join(build, d))
+            shutil.copy(os.path.join(src, flat and "src.txt" or d + "/src.txt"), os.path.join(build, d, "src.txt"))
+        subprocess.check_call([stub, "DOMAINS=" + ",".join(domains)], cwd=build, env=env, stdout=open(os.devnull, "w"))
+        os.makedirs(os.path.join(root, "jenkins", c))
+        for tarball in tarballs:
+            if -1 != tarball.find("_private."):
+                member = "Installs/Linux/private"
+            else:
+                member = "Installs/Linux/External"
+            with tarfile.open(os.path.join(root, "jenkins", c, tarball), "w:gz") as tar:
+                tar.add(os.path.join(build, member), member)
+
+#
+# Stand-in Jenkins serving <jenkins>/<project>/<tarball> as
+# /job/XMOS/job/<project>/job/master/lastSuccessfulBuild/artifact/<tarball>
+#
+class ArtifactHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        parts = self.path.split("/")
+        path = None
+        if len(parts) > 4:
+            path = os.path.join(self.server.root, parts[4], parts[-1])
+        if not path or not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        st = os.stat(path)
+        etag = '"%x-%x"' % (st.st_size, int(st.st_mtime))
+        if self.headers.getheader("if-none-match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(st.st_size))
+        self.end_headers()
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+    def log_message(self, *a):
+        pass
+
+class ArtifactServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def StartArtifactServer(root):
+    server = ArtifactServer(("127.0.0.1", 0), ArtifactHandler)
+    server.root = root
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+#
+# Run build_tools.py in "root" and return its wall time and per-phase times
+#
+def Run(name, root, argv, env, logName):
+    timingDir = os.path.join(root, "timing", name)
+    shutil.rmtree(timingDir, True)
+    cmd = [sys.executable, BUILD_TOOLS, "--timing", timingDir] + argv
+    start = time.time()
+    with open(logName, "w") as log:
+        r = subprocess.call(cmd, cwd=root, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.time() - start
+    if 0 != r:
+        raise Exception("%s failed (%d), see %s" % (" ".join(cmd), r, logName))
+
+    with open(os.path.join(timingDir, "timing.json")) as f:
+        timing = json.load(f)
+    return {"wall" : wall,
+            "phases" : dict([(p, v["wall"]) for p, v in timing["phases"].items()]),
+            "critical_path" : timing["critical_path"]["wall"]}
+
+def Benchmark(t, name, root, args):
+    containers, files, fileSize = sizes[name]
+    containers = [c for c in t["all_containers"] if not containers or c in containers]
+    dependents = [(len([d for d in containers if c in t["all_containers"][d]]), c) for c in containers]
+    changed = max(dependents)[1]
+    print "%s: %d containers, %d files of %d bytes per domain" % (name, len(containers), files, fileSize)
+
+    start = time.time()
+    Generate(t, root, containers, files, fileSize)
+    print "  generated in %.1fs" % (time.time() - start,)
+
+    server = StartArtifactServer(os.path.join(root, "jenkins"))
+    env = dict(os.environ)
+    env.update({"GIT_CONFIG_COUNT" : "3",
+                "GIT_CONFIG_KEY_0" : "url.file://%s/remotes/int/.insteadOf" % (root,), "GIT_CONFIG_VALUE_0" : "git@github0.xmos.com:xmos-int/",
+                "GIT_CONFIG_KEY_1" : "url.file://%s/remotes/pub/.insteadOf" % (root,), "GIT_CONFIG_VALUE_1" : "git@github.com:xmos/",
+                "GIT_CONFIG_KEY_2" : "protocol.file.allow",                            "GIT_CONFIG_VALUE_2" : "always"})
+    common = ["--jenkins-url", "http://127.0.0.1:%d" % (server.server_address[1],),
+              "--git-cache", os.path.join(root, "gitcache"), "--artifact-store", os.path.join(root, "artifacts"),
+              "--history", os.path.join(root, "history.db")] + args.build_tools_args.split()
+
+    results = collections.OrderedDict()
+    try:
+        for run, argv in runs:
+            if "incremental" == run:
+                # A source change in one domain
+                # (a flat container's repo is in the dir named after its domain, so the path is the same)
+                src = os.path.join(root, "working", changed, Domains(t, changed)[0], "src.txt")
+                with open(src, "w") as f:
+                    f.write("2\n")
+
+            expanded = []
+            for a in argv:
+                if "{containers}" == a:
+                    expanded += containers
+                else:
+                    expanded.append(a.replace("{changed}", changed).replace("{jobs}", str(args.jobs)))
+            results[run] = Run(run, root, common + expanded, env, os.path.join(root, "%s.log" % (run,)))
+            print "  %-12s %7.2fs" % (run, results[run]["wall"])
+    finally:
+        server.shutdown()
+
+    results["end_to_end"] = {"wall" : results["unpack"]["wall"] + results["build"]["wall"]}
+    return {"containers" : len(containers), "files" : files, "file_size" : fileSize, "runs" : results}
+
+#
+# Print the changes from "old" results to "new", marking those over "threshold" slower
+#
+def Compare(old, new, threshold):
+    regressions = 0
+    for size, result in new["sizes"].items():
+        if size not in old["sizes"]:
+            continue
+        for run, r in result["runs"].items():
+            o = old["sizes"][size]["runs"].get(run)
+            if not o:
+                continue
+            items = [(run, o["wall"], r["wall"])]
+            items += [("%s/%s" % (run, p), o.get("phases", {}).get(p), w) for p, w in sorted(r.get("phases", {}).items())]
+            for label, before, after in items:
+                if not before or before < 0.05:
+                    continue
+                change = (after - before) / before
+                mark = ""
+                if change > threshold:
+                    mark = "  REGRESSION"
+                    regressions += 1
+                print "%-8s %-28s %8.2fs -> %8.2fs  %+6.1f%%%s" % (size, label, before, after, change * 100, mark)
+    return regressions
+
+def ParseArgs():
+    parser = argparse.ArgumentParser(description="Benchmark build_tools.py on generated working areas")
+    parser.add_argument('--sizes',      default="small,medium",             help='Comma separated tree sizes to run (%s)' % (", ".join(sizes),))
+    parser.add_argument('--root',       default="bench",                    help='Directory to generate the trees in')
+    parser.add_argument('--out',        default="benchmark.json",           help='File to write the results to')
+    parser.add_argument('-j', '--jobs', default=4,     type=int,            help='build_tools.py -j for the builds')
+    parser.add_argument('--build-tools-args', default="",                   help='Extra build_tools.py arguments for every run (e.g. "--archiver zstd")')
+    parser.add_argument('--compare',    default=None,                       help='Previous results to compare with')
+    parser.add_argument('--threshold',  default=0.1,   type=float,          help='Slowdown (fraction) reported as a regression by --compare')
+    parser.add_argument('--keep',       default=False, action='store_true', help='Keep the generated trees')
+    return parser.parse_args()
+
+args = ParseArgs()
+tables = BuildToolsTables()
+
+results = {"time" : time.time(), "host" : platform.node(), "cpus" : os.sysconf("SC_NPROCESSORS_ONLN"),
+           "jobs" : args.jobs, "build_tools_args" : args.build_tools_args, "sizes" : collections.OrderedDict()}
+try:
+    results["revision"] = subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                                  cwd=os.path.dirname(BUILD_TOOLS)).strip()
+except (subprocess.CalledProcessError, OSError):
+    results["revision"] = None
+
+for size in args.sizes.split(","):
+    if size not in sizes:
+        raise Exception("Unknown size %s, use one of %s" % (size, ", ".join(sizes)))
+    root = os.path.abspath(os.path.join(args.root, size))
+    results["sizes"][size] = Benchmark(tables, size, root, args)
+    if not args.keep:
+        shutil.rmtree(root, True)
+
+with open(args.out + ".tmp", "w") as f:
+    json.dump(results, f, indent=1)
+os.rename(args.out + ".tmp", args.out)
+print "Results written to %s" % (args.out,)
+
+if args.compare:
+    with open(args.compare) as f:
+        if Compare(json.load(f), results, args.threshold):
+            sys.exit(1)
+
+#
+# Example commands
+#
+#  # Benchmark the small and medium trees, then compare a change with them
+#  python benchmark.py --out before.json
+#  python benchmark.py --out after.json --compare before.json
+#
+#  # All sizes, building 8 containers at once with zstd tarballs
+#  python benchmark.py --sizes small,medium,large -j 8 --build-tools-args "--archiver zstd"
@@ -1,17 +1,41 @@
 #!/usr/bin/env python2
 
 import argparse
+import atexit
+import BaseHTTPServer
 import collections
+import contextlib
+import errno
+import fnmatch
 import glob
+import gzip
+import hashlib
+import httplib
+import json
+import multiprocessing
 import os
 import os.path
 import platform
+import Queue
+import re
 import shutil
+import signal
+import socket
+import SocketServer
+import stat
+import struct
 import subprocess
 import sys
+import tarfile
+import threading
+import time
+import urlparse
 
-BUILD_HOST=None
-DEST_HOST=None
+from multiprocessing.pool import ThreadPool
+
+# Absolute path of this script - used to re-invoke it for each container when
+# building in parallel
+SCRIPT = os.path.abspath(__file__)
 
 #
 # The following is used to map names used in the Jenkinsfile to repo names
@@ -94,463 +118,3748 @@ build_domains = {
 
 ignoreDomains = ["lib_xmlobject_py"]
 
-def ParseArgs():
+#
+# The domains within a container which each domain depends on, used by --incremental
+# to rebuild the domains depending on a changed domain. Where a container is not
+# listed every domain after a changed domain (in the build_domains order, or
+# alphabetically for the Build.pl dirs found) is assumed to depend on it.
+#
+domain_dependencies = {
+  # Container             # {domain : (domains it depends on)}
+}
+
+#
+# Rough peak memory (GB) of building each container, used by --memory-limit to
+# avoid running several memory hungry builds (e.g. the LLVM links) at once.
+# Containers not listed are assumed to need default_container_memory.
+#
+container_memory = {
+  # Container             # GB
+  "xc_compiler_combined"  : 16,
+  "tools_libs_combined"   : 8,
+  "xgdb_combined"         : 4,
+  "xsim_combined"         : 4,
+}
+
+default_container_memory = 2
+
+def ArgParser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--clone',      default=False, action='store_true', help='Create a new working area')
     parser.add_argument('--debugbuild', default=False, action='store_true', help='Build with debug (CONFIG=Debug)')
     parser.add_argument('--debug',      default=False, action='store_true', help='Enable debug prints')
     parser.add_argument('--dryrun',     default=False, action='store_true', help='Do not execute commands')
-    parser.add_argument('--git',                                            help='Run git command on each repo')
+    parser.add_argument('--git',                                            help='Run git command on each repo and submodule (e.g. "fetch" or "git status -s"), then summarise their states')
+    parser.add_argument('--git-jobs',   default=8,     type=int,            help='Number of repos to run the --git command in at once')
+    parser.add_argument('--git-json',   default=None,                       help='Also write the --git results as JSON to this file (- for stdout)')
     parser.add_argument('--mkroot',     default=False, action='store_true', help='Make a new working area root')
     parser.add_argument('--update',     default=False, action='store_true', help='Use with --clone to update a new working area with latest Jenkins tarballs')
     parser.add_argument('--reimport',   default=False, action='store_true', help='Re-reimport depndendencies build by parent containsers')
+    parser.add_argument('-j', '--jobs', default=1,     type=int,            help='Number of containers to build in parallel')
+    parser.add_argument('--make-jobs',  default=0,     type=int,            help='Total make jobs shared by all the Build.pl runs (a GNU make jobserver), default: each make chooses')
+    parser.add_argument('--memory-limit', default=0,   type=float,          help='Memory (GB) for parallel builds, only start a container if the estimated memory of those running fits')
+    parser.add_argument('--keep-going', default=False, action='store_true', help='Keep building containers which do not depend on a failed container')
+    parser.add_argument('--no-cache',   default=False, action='store_true', help='Always run Build.pl, do not use or update the build cache')
+    parser.add_argument('--cache-dir',  default="cache",                    help='Directory (under working) holding the exports of previous builds')
+    parser.add_argument('--cache-size', default=20,    type=float,          help='Size limit (GB) of the build cache, enforced by removing the least recently used builds')
+    parser.add_argument('--no-overlay', default=False, action='store_true', help='Extract each dependency tarball into the container rather than cloning a cached merged import tree')
+    parser.add_argument('--overlay-dir', default="overlays",                help='Directory (under working) holding the merged import trees')
+    parser.add_argument('--import-hardlinks', default=False, action='store_true', help='Hard link imported files from the import overlay if they cannot be reflinked (a build changing one in place changes it in every container importing it)')
+    parser.add_argument('--archiver',   default="auto", choices=("auto", "tar", "python", "pigz", "zstd"),
+                                                                            help='How tarballs are compressed/extracted: tar (and gzip), in-process python, pigz or zstd (local use only, still named .tgz, so tar xzf cannot extract them). auto uses pigz if installed')
+    parser.add_argument('--archive-jobs', default=multiprocessing.cpu_count(), type=int, help='Number of tarballs to create/extract at once, and threads for pigz/zstd')
+    parser.add_argument('--jenkins-url', default="http://srv-bri-jtools:8080", help='Jenkins server to download the tarballs from')
+    parser.add_argument('--artifact-store', default="~/.build_tools/artifacts", help='Directory storing the downloaded and built tarballs by hash (shared by all working areas)')
+    parser.add_argument('--artifact-store-size', default=50, type=float,   help='Size limit (GB) of the artifact store, enforced by removing the least recently used tarballs not in use')
+    parser.add_argument('--no-artifact-store', default=False, action='store_true', help='Download tarballs directly into the containers')
+    parser.add_argument('--artifact-build', default=None, action='append', metavar="JOB=BUILD",
+                                                                            help='Use this Jenkins build (number) of a job (e.g. xcommon=123) rather than the last successful one, may be repeated')
+    parser.add_argument('--download-jobs', default=8, type=int,             help='Number of tarballs to download at once')
+    parser.add_argument('--clone-jobs', default=4, type=int,                help='Number of repos to clone/fetch at once')
+    parser.add_argument('--git-cache',  default="~/.build_tools/git",       help='Directory of git mirrors which clones borrow objects from (shared by all working areas)')
+    parser.add_argument('--from',       default=None,  dest='from_area',    help='With --clone, create the working area from this existing one (sharing its git objects, linking its Installs, exports and caches)')
+    parser.add_argument('--snapshot-hardlinks', default=False, action='store_true', help='With --from, hard link Installs files if they cannot be reflinked (a build changing them in place changes both areas)')
+    parser.add_argument('--no-git-cache', default=False, action='store_true', help='Clone directly from the servers without using the git cache')
+    parser.add_argument('--incremental', default=False, action='store_true', help='Only build the domains which have changed since the last build (and those depending on them)')
+    parser.add_argument('--affected-by', default=None, nargs="*", metavar="CONTAINER",
+                                                                            help='Build these containers and all containers depending on them (with no containers: those changed since they were last built)')
+    parser.add_argument('--watch',      default=False, action='store_true', help='Watch the container repos and rebuild the changed containers (incrementally) and those depending on them')
+    parser.add_argument('--watch-delay', default=1.0,  type=float,          help='Seconds without changes before --watch rebuilds')
+    parser.add_argument('--show-deps',  default=False, action='store_true', help='Show the containers imported by each container and exit')
+    parser.add_argument('--shared-cache', default=None,                     help='Directory or http:// URL of a build cache shared with others to fetch builds from and push them to')
+    parser.add_argument('--no-shared-push', default=False, action='store_true', help='Only fetch from the shared cache, do not push builds to it')
+    parser.add_argument('--shared-cache-size', default=100, type=float,     help='Size limit (GB) of the shared cache, enforced by removing the least recently used builds')
+    parser.add_argument('--serve-cache', default=None,                      help='Run an HTTP server for a shared cache held in this directory')
+    parser.add_argument('--serve-port', default=8050, type=int,             help='Port for --serve-cache')
+    parser.add_argument('--serve-address', default="localhost",             help='Address for --serve-cache to listen on (e.g. 0.0.0.0 for all interfaces - uploads are not authenticated, so only on a trusted network)')
+    parser.add_argument('--timing',     default=None,                       help='Directory (under working) to write timing.json and a Chrome trace (trace.json) of the phases of the run to')
+    parser.add_argument('--history',    default="~/.build_tools/history.db", help='Database of the durations of previous builds and unpacks (shared by all working areas)')
+    parser.add_argument('--no-history', default=False, action='store_true', help='Do not record or use the build history')
+    parser.add_argument('--plan',       default=False, action='store_true', help='Print the containers which would be built with their estimated times (from the build history), the estimated wall time and the critical path')
+    parser.add_argument('--logdir',     default="logs",                     help='Directory (under working) for per-container logs when building in parallel')
+    parser.add_argument('--working',    default="working",                  help='The working area to use (or create with --mkroot)')
     parser.add_argument('containers',   default=None,  nargs="*")
+    return parser
 
-    args = parser.parse_args()
-    return args
-
-
-def Cmd(cmd, useShell=False):
-    print( "Running cmd: ", cmd)
-    if args.dryrun:
-        return
-
-    if useShell:
-        cmdsplit = cmd
-    else:    
-        cmdsplit = cmd.split()
+#
+# Parse the command line "argv" (or the default options, if it is empty)
+#
+def ParseArgs(argv):
+    return ArgParser().parse_args(argv)
 
-    handle = subprocess.Popen(cmdsplit, shell=useShell)
 
-    r = handle.wait()
-    if 0 != r:
-        raise Exception("Error %s, failed cmd: %s" % (r, cmdsplit))
+#
+# Build the command line used to re-invoke this script for a single container.
+# All options which differ from their defaults are passed on, except those in "exclude"
+#
+def ChildArgs(spec, exclude):
+    argv = [sys.executable, SCRIPT]
+    for action in ArgParser()._actions:
+        if not action.option_strings or action.dest in exclude:
+            continue
+        value = getattr(args, action.dest, action.default)
+        if value == action.default:
+            continue
+        if 0 == action.nargs:
+            argv.append(action.option_strings[-1])
+        elif isinstance(value, list):
+            for v in value:
+                argv += [action.option_strings[-1], str(v)]
+        else:
+            argv += [action.option_strings[-1], str(value)]
+    argv.append(spec)
+    return argv
 
+#
+# Sessions.
+#
+# A Session is a working area with the options (those of the command line, see
+# ArgParser), hosts and jobserver (--make-jobs) used to work in it. The functions
+# below use the session of the calling thread - its options as "args" and its
+# working area through Path() - and never change the current directory, so
+# sessions (of the same or different working areas) can be used by several threads
+# of one process. The threads started for a session (by RunParallel) use the same
+# session.
+#
+#   import build_tools
+#   session = build_tools.Session("/home/me/tools/working", jobs=4, keep_going=True)
+#   session.Clone(["xas", "xmap"])
+#   failed, skipped = session.Build(["xas", "xmap"])
+#   session.Git("status -s")
+#
+# The command line (Main()) is a Session of the options parsed.
+#
+sessionLocal = threading.local()
 
-def Build(container, domains, deps, debugbuild, reimport):
-    print "Build(container %s, deps %s, debugbuild %s, reimport %s)" % (container, deps, debugbuild, reimport)
+def CurrentSession():
+    session = getattr(sessionLocal, "session", None)
+    if session is None:
+        raise Exception("No build_tools session in this thread - use the methods of a Session")
+    return session
 
-    if "PC" == DEST_HOST:
-        hostPrefix = "Microsoft"
-        hostPostfix = "tgz"
-    else:
-        hostPrefix = "Linux64"
-        hostPostfix = "tgz"
+#
+# The options of the current thread's session
+#
+class SessionOptions(object):
+    def __getattr__(self, name):
+        return getattr(CurrentSession().options, name)
 
-    # Remove any temporary import/export dirs
-    for i in ("Installs_imports", "Installs_exports"):
-        try:
-            shutil.rmtree(container +"/" + i, True)
-        except WindowsError, e:
-            print "Failed shutil.rmtree(%s/%s) : %s" % (container, i, e)
-            pass
+    def __setattr__(self, name, value):
+        setattr(CurrentSession().options, name, value)
 
-    # Iterate of the locally built dependency container and unpack the their tarballs
-    for d in deps:
-        import_list = container_exports[d]
+args = SessionOptions()
 
-        print "Build: depndendency %s, import list %s" % (d, import_list)
+#
+# Return the path of "parts" in the current session's working area
+#
+def Path(*parts):
+    return os.path.join(CurrentSession().working, *parts)
 
-        os.chdir(container)
-        for g in import_list:
-            print "g", g
+#
+# Return the host building (BUILD_HOST) and the host being built for (DEST_HOST)
+#
+def DetectHosts():
+    if platform.system() != "Windows" or os.environ.get('MSYSTEM') != None:
+        # Building On Linux (for Linux) or on MINGW for PC
+        buildHost = "Linux"
+    else:
+        buildHost = "PC"
 
-            fileName = g % (hostPrefix, hostPostfix)
+    if os.environ.get('SYSTEMDRIVE'):
+        # Building on Windows (for Windows) or on MINGW64 for Windows
+        destHost = "PC"
+    else:
+        destHost = "Linux"
+    return buildHost, destHost
 
-            if -1 == d.find("xcommon"):
-                cmd = "tar -xf ../exports/%s" % (fileName,)
+#
+# The prefix and extension of the names of the tarballs for the host being built for
+#
+def HostTarballs():
+    if "PC" == CurrentSession().destHost:
+        return "Microsoft", "tgz"
+    return "Linux64", "tgz"
+
+class Session(object):
+    #
+    # "options" is the parsed command line, otherwise the defaults updated with
+    # "kwargs" (the option dests, e.g. jobs=4). Paths in the options which are
+    # "under working" are relative to "working", others to the current directory.
+    #
+    def __init__(self, working=None, options=None, **kwargs):
+        if options is None:
+            options = ParseArgs([])
+        for name, value in kwargs.items():
+            if not hasattr(options, name):
+                raise Exception("Session: unknown option %s" % (name,))
+            setattr(options, name, value)
+        if working is not None:
+            options.working = working
+
+        self.options = options
+        self.working = os.path.abspath(options.working)
+        options.working = self.working
+        self.buildHost, self.destHost = DetectHosts()
+        self.timingEvents = []
+        self.mirrorsFetched = set()
+
+        ValidateContainers()
+
+        # One jobserver for the session's builds, or that of the build_tools.py
+        # running this one (see BuildParallel)
+        self.jobserverReader = None
+        self.jobserver = None
+        if os.environ.get("BUILD_TOOLS_JOBSERVER"):
+            self.jobserver = [int(i) for i in os.environ["BUILD_TOOLS_JOBSERVER"].split(",")]
+        elif options.make_jobs > 0 and "Linux" == self.buildHost:
+            self.jobserver = StartJobserver(options.make_jobs)
+
+        # The container tables (shared by all sessions)
+        self.all_containers = all_containers
+        self.container_exports = container_exports
+        self.build_domains = build_domains
+
+        for name in ("cache_dir", "overlay_dir", "logdir", "timing"):
+            if getattr(options, name):
+                setattr(options, name, os.path.join(self.working, getattr(options, name)))
+        for name in ("artifact_store", "history", "git_cache"):
+            setattr(options, name, os.path.abspath(os.path.expanduser(getattr(options, name))))
+        if options.shared_cache and not IsHttp(options.shared_cache):
+            options.shared_cache = os.path.abspath(options.shared_cache)
+        if options.from_area:
+            options.from_area = os.path.abspath(options.from_area)
+        if options.git_json and "-" != options.git_json:
+            options.git_json = os.path.abspath(options.git_json)
+
+    #
+    # Make this the session of the calling thread (for the functions below)
+    #
+    def __enter__(self):
+        sessionLocal.__dict__.setdefault("stack", []).append(getattr(sessionLocal, "session", None))
+        sessionLocal.session = self
+        return self
+
+    def __exit__(self, *exc):
+        sessionLocal.session = sessionLocal.stack.pop()
+
+    #
+    # The container specs ("container" or "container:domain,domain") in dependency
+    # order, all the containers if none are given
+    #
+    def Todo(self, containers=None):
+        containers = containers or list(self.all_containers)
+        for c in containers:
+            if SplitSpec(c)[0] not in self.all_containers:
+                raise Exception("Invalid container %s" % (SplitSpec(c)[0],))
+        todo = []
+        for c in TopoSort(self.all_containers):
+            todo += [spec for spec in containers if c == SplitSpec(spec)[0]]
+        return todo
+
+    #
+    # Create the working area (with "mkroot") and clone the containers into it, or
+    # update them with the latest Jenkins tarballs. With "fromArea" the containers
+    # are cloned from that working area instead (see CloneFrom). The git mirrors are
+    # fetched (once) by each call.
+    #
+    def Clone(self, containers=None, update=False, fromArea=None, mkroot=False):
+        with self:
+            self.mirrorsFetched = set()
+            if mkroot:
+                os.mkdir(self.working)
+                os.mkdir(Path("exports"))
+            todo = [SplitSpec(c)[0] for c in self.Todo(containers)]
+            if fromArea:
+                CloneFrom(os.path.abspath(fromArea), todo)
             else:
-                # Special case for xcommon
-                installPath = "Installs/%s/External/Product" % (DEST_HOST,)
-                if not os.path.isdir(installPath):
-                    Cmd("mkdir -p %s" % (installPath,))
-                cmd = "tar -C %s -xf ../exports/%s" % (installPath, fileName)
+                Unpack(todo, update)
+
+    #
+    # Import the exports of the containers "container" depends on into it
+    #
+    def Import(self, container):
+        with self:
+            prefix, postfix = HostTarballs()
+            with Phase("import", container):
+                ImportContainer(container, Imports(container), prefix, postfix)
+
+    #
+    # Build the containers (all if none are given) in dependency order, up to "jobs"
+    # at once. Returns the lists of the containers which failed and were not built.
+    #
+    def Build(self, containers=None, jobs=None, keepGoing=None):
+        with self:
+            jobs = jobs or self.options.jobs
+            if keepGoing is None:
+                keepGoing = self.options.keep_going
+            todo = self.Todo(containers)
+            if jobs > 1:
+                return BuildParallel(todo, jobs, keepGoing, self.options.logdir)
+            return BuildSerial(todo, keepGoing)
+
+    #
+    # Create the export tarballs of a built container from its Installs
+    #
+    def Export(self, container, debugbuild=None):
+        with self:
+            if debugbuild is None:
+                debugbuild = self.options.debugbuild
+            prefix, postfix = HostTarballs()
+            ExportContainer(container, debugbuild, prefix, postfix)
+
+    #
+    # Run a git command in every repo of the containers (all those cloned if none
+    # are given), returning the repos where it failed
+    #
+    def Git(self, cmd, containers=None):
+        with self:
+            return Git([SplitSpec(c)[0] for c in self.Todo(containers)], cmd)
+
+    def Plan(self, containers=None):
+        with self:
+            Plan(self.Todo(containers))
+
+    def Watch(self, containers=None):
+        with self:
+            Watch([SplitSpec(c)[0] for c in self.Todo(containers)])
+
+    def WriteTiming(self):
+        with self:
+            WriteTiming()
 
-            print("Expanding import tarball: ", cmd)
-            Cmd(cmd)
 
-        os.chdir("..")
+#
+# Timing.
+#
+# Phase() records the wall time, CPU time (of this process and its finished child
+# processes) and bytes read/written to disk of each phase of a run. The CPU time
+# and bytes are for the whole process, so include any other phases running in
+# other threads at the same time.
+#
+# With --timing each process writes its phases to <timing>/events/<pid>.json at
+# exit, and the top level process (not one started by BuildParallel) merges them
+# into timing.json (a summary with the critical path through the containers built)
+# and trace.json (for chrome://tracing or https://ui.perfetto.dev).
+#
+timingLock = threading.Lock()
+
+def ResourceUsage():
+    t = os.times()
+    cpu = t[0] + t[1] + t[2] + t[3]
+    try:
+        import resource
+        self = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # Blocks are 512 bytes
+        read = (self.ru_inblock + children.ru_inblock) * 512
+        written = (self.ru_oublock + children.ru_oublock) * 512
+    except ImportError:
+        read = written = 0
+    return cpu, read, written
+
+@contextlib.contextmanager
+def Phase(name, container=None, detail=None):
+    start = time.time()
+    cpu, read, written = ResourceUsage()
+    failed = False
+    try:
+        yield
+    except:
+        failed = True
+        raise
+    finally:
+        end = time.time()
+        cpuEnd, readEnd, writtenEnd = ResourceUsage()
+        event = {"name" : name, "container" : container, "start" : start, "wall" : end - start,
+                 "cpu" : cpuEnd - cpu, "read_bytes" : readEnd - read, "write_bytes" : writtenEnd - written,
+                 "pid" : os.getpid(), "tid" : threading.current_thread().ident, "failed" : failed}
+        if detail:
+            event["detail"] = detail
+        with timingLock:
+            CurrentSession().timingEvents.append(event)
 
-    # The above steps have pulled in the stuff built and exported by parent containers
-    if reimport:
+#
+# Return the containers on the longest path (by "build" phase wall time) through the
+# dependency graph of the containers built, and its length
+#
+def CriticalPath(durations):
+    finish = {}
+    previous = {}
+    for c in all_containers:
+        if c not in durations:
+            continue
+        finish[c] = durations[c]
+        previous[c] = None
+        for d in all_containers[c]:
+            if d in finish and finish[d] + durations[c] > finish[c]:
+                finish[c] = finish[d] + durations[c]
+                previous[c] = d
+
+    if not finish:
+        return [], 0
+    last = max(finish, key=lambda c: finish[c])
+    path = []
+    c = last
+    while c:
+        path.insert(0, c)
+        c = previous[c]
+    return path, finish[last]
+
+def WriteTiming():
+    eventsDir = os.path.join(args.timing, "events")
+    if not os.path.isdir(eventsDir):
+        os.makedirs(eventsDir)
+    with open(os.path.join(eventsDir, "%d.json" % (os.getpid(),)), "w") as f:
+        json.dump(CurrentSession().timingEvents, f)
+
+    if os.environ.get("BUILD_TOOLS_CHILD"):
         return
 
-    if "" == domains:
-        # No domains specified by the user
-
-        if build_domains.has_key(container):
-            domains = build_domains[container]
-        else:
-            # Find the list of domains to build - any subdir with a Build.pl file is selected
-            os.chdir(container)
-            glist = glob.glob("*/Build.pl")
-            os.chdir("..")
-
-            print "glist: ", glist
+    events = []
+    for name in glob.glob(os.path.join(eventsDir, "*.json")):
+        with open(name) as f:
+            events += json.load(f)
+    if not events:
+        return
+    runStart = min([e["start"] for e in events])
+    runEnd = max([e["start"] + e["wall"] for e in events])
 
-            for g in glist:
-                d = os.path.dirname(g)
-                if d in ignoreDomains:
-                    continue
-                domains += d + ","
+    summary = {"wall" : runEnd - runStart, "phases" : {}, "containers" : {}}
+    builds = {}
+    for e in events:
+        if "cmd" == e["name"]:
+            continue
+        p = summary["phases"].setdefault(e["name"], {"wall" : 0, "cpu" : 0, "read_bytes" : 0, "write_bytes" : 0, "count" : 0})
+        for k in ("wall", "cpu", "read_bytes", "write_bytes"):
+            p[k] += e[k]
+        p["count"] += 1
+        if e["container"]:
+            c = summary["containers"].setdefault(e["container"], {})
+            c[e["name"]] = c.get(e["name"], 0) + e["wall"]
+            if "build" == e["name"]:
+                builds[e["container"]] = e
+
+    path, length = CriticalPath(dict([(c, e["wall"]) for c, e in builds.items()]))
+    summary["critical_path"] = {"containers" : path, "wall" : length}
+    summary["slowest_commands"] = sorted([{"cmd" : e.get("detail"), "wall" : e["wall"], "cpu" : e["cpu"]}
+                                          for e in events if "cmd" == e["name"]], key=lambda e: -e["wall"])[:20]
+
+    trace = []
+    for e in events:
+        name = e["name"]
+        if e["container"]:
+            name = "%s %s" % (name, e["container"])
+        args_ = {"cpu" : e["cpu"], "read_bytes" : e["read_bytes"], "write_bytes" : e["write_bytes"], "failed" : e["failed"]}
+        if "detail" in e:
+            args_["detail"] = e["detail"]
+        trace.append({"name" : name, "cat" : e["name"], "ph" : "X", "ts" : (e["start"] - runStart) * 1e6,
+                      "dur" : e["wall"] * 1e6, "pid" : e["pid"], "tid" : e["tid"], "args" : args_})
+
+    # The critical path as its own row
+    trace.append({"name" : "process_name", "ph" : "M", "pid" : 0, "args" : {"name" : "critical path"}})
+    for c in path:
+        e = builds[c]
+        trace.append({"name" : c, "cat" : "critical_path", "ph" : "X", "ts" : (e["start"] - runStart) * 1e6,
+                      "dur" : e["wall"] * 1e6, "pid" : 0, "tid" : 0})
+
+    with open(os.path.join(args.timing, "timing.json"), "w") as f:
+        json.dump(summary, f, indent=1)
+    with open(os.path.join(args.timing, "trace.json"), "w") as f:
+        json.dump({"traceEvents" : trace, "displayTimeUnit" : "ms"}, f)
+
+    print "Timing: %.1fs, critical path %s (%.1fs), see %s" % (summary["wall"], " -> ".join(path), length,
+                                                                os.path.join(args.timing, "timing.json"))
 
-    if debugbuild:
-       config = "Debug"
-    else:
-       config = "Release"
+#
+# Build history.
+#
+# The phases of each container built (by BuildSerial, so also for each container
+# BuildParallel starts) and unpacked are recorded in an sqlite database (--history,
+# shared by all working areas) with the sizes of the tarballs exported or downloaded.
+# For a build the domains passed to Build.pl are recorded, and whether its exports
+# were restored from the build cache rather than built.
+#
+# The history gives the estimated time of building each container, used to start
+# the containers with the longest estimated time to the end of the build first when
+# building in parallel, and by --plan.
+#
+HISTORY_SAMPLES = 5
+
+def History():
+    import sqlite3
+    historyDir = os.path.dirname(args.history)
+    if historyDir and not os.path.isdir(historyDir):
+        os.makedirs(historyDir)
+    db = sqlite3.connect(args.history, timeout=60)
+    db.execute("CREATE TABLE IF NOT EXISTS phases (time REAL, container TEXT, phase TEXT, detail TEXT, "
+               "domains TEXT, wall REAL, cpu REAL, cached INTEGER, failed INTEGER)")
+    db.execute("CREATE TABLE IF NOT EXISTS artifacts (time REAL, container TEXT, name TEXT, size INTEGER)")
+    db.execute("CREATE INDEX IF NOT EXISTS phases_container ON phases (container, phase)")
+    return db
 
-    #    cmd = "bash -c 'cd %s/infr_scripts_pl/Build && ls -l SetupEnv && source ./SetupEnv && cd ../.. && Build.pl DOMAINS=%s CONFIG=%s'" % (container, domains, config)
-    ## DEBUG Build
-    ##    cmd = "bash -c 'cd %s/infr_scripts_pl/Build && ls -l SetupEnv && source ./SetupEnv && cd ../.. && Build.pl DOMAINS=%s CONFIG=Debug'" % (container, domains)
-    ## RELEASE Build
+#
+# Record the timing "events" of building or unpacking. For a build "domains" are
+# those requested for the container ("" for its default domains).
+#
+def RecordPhases(events, domains=None):
+    if args.no_history or args.dryrun:
+        return
+    rows = []
+    for e in events:
+        if "cmd" == e["name"]:
+            continue
+        cached = None
+        if "build" == e["name"]:
+            cached = not [i for i in events if i["container"] == e["container"] and "import" == i["name"]]
+        rows.append((e["start"], e["container"], e["name"], e.get("detail"), domains,
+                     e["wall"], e["cpu"], cached, e["failed"]))
+    try:
+        db = History()
+        with db:
+            db.executemany("INSERT INTO phases VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        db.close()
+    except Exception, e:
+        print "History: failed to record %d phases in %s: %s" % (len(rows), args.history, e)
+
+def RecordArtifacts(container, paths):
+    if args.no_history or args.dryrun:
+        return
+    now = time.time()
+    rows = [(now, container, os.path.basename(p), os.path.getsize(p)) for p in paths if os.path.exists(p)]
+    try:
+        db = History()
+        with db:
+            db.executemany("INSERT INTO artifacts VALUES (?, ?, ?, ?)", rows)
+        db.close()
+    except Exception, e:
+        print "History: failed to record %d artifacts in %s: %s" % (len(rows), args.history, e)
 
-    # TODO FAILS "source ./SetupEnv" on msys2
-    #    cmd = "bash -c 'which bash && cd %s/infr_scripts_pl/Build && ls -l && ls -l SetupEnv && source ./SetupEnv && cd ../.. && Build.pl DOMAINS=%s CONFIG=Release'" % (container, domains)
+#
+# Return {container : estimated build seconds} for the container specs in "todo"
+# (the average of the recent builds with the same domains, or of any recent builds
+# of the container), leaving out containers never built
+#
+def EstimateBuilds(todo):
+    estimates = {}
+    if args.no_history or not os.path.exists(args.history):
+        return estimates
+    try:
+        db = History()
+        for repo, domains in [SplitSpec(c) for c in todo]:
+            for query, params in (("AND domains = ?", (domains,)), ("", ())):
+                walls = [r[0] for r in db.execute("SELECT wall FROM phases WHERE container = ? AND phase = 'build' "
+                                                  "AND NOT cached AND NOT failed %s ORDER BY time DESC LIMIT ?" % (query,),
+                                                  (repo,) + params + (HISTORY_SAMPLES,))]
+                if walls:
+                    estimates[repo] = sum(walls) / len(walls)
+                    break
+        db.close()
+    except Exception, e:
+        print "History: failed to read %s: %s" % (args.history, e)
+    return estimates
+
+def ExportSizes(containers):
+    sizes = {}
+    if args.no_history or not os.path.exists(args.history):
+        return sizes
+    db = History()
+    for c in containers:
+        # The sizes recorded by the latest build or unpack of the container
+        latest = db.execute("SELECT MAX(time) FROM artifacts WHERE container = ?", (c,)).fetchone()[0]
+        if latest is not None:
+            sizes[c] = db.execute("SELECT SUM(size) FROM artifacts WHERE container = ? AND time = ?", (c, latest)).fetchone()[0]
+    db.close()
+    return sizes
 
-    if "Linux" == BUILD_HOST:
-        with open("build.sh", "w") as f:
-            f.write("#!/usr/bin/bash\n")
-            f.write("cd %s/infr_scripts_pl/Build\n" % (container,))
-            f.write("source ./SetupEnv\n")
-            if os.environ.get('MSYSTEM'):
-                f.write("export PATH=$PATH:/apache-ant-1.10.12/bin")
-                f.write("export JAVA_HOME=/jdk-18.0.2.1")
-            f.write("cd ../..\n")
-            f.write("Build.pl DOMAINS=%s CONFIG=%s\n" % (domains, config))
+#
+# Return {container : priority} for the containers in "specs", the estimated time
+# from starting the container to the end of the build (its own estimate plus the
+# longest chain of containers in "specs" depending on it). Containers never built
+# are estimated as the average of those which have been.
+#
+def BuildPriorities(specs, estimates):
+    default = estimates and sum(estimates.values()) / len(estimates) or 0
+    priorities = {}
+    for repo in reversed(TopoSort(specs.keys())):
+        dependents = [d for d in specs if repo in all_containers[d]]
+        priorities[repo] = estimates.get(repo, default) + max([priorities[d] for d in dependents] or [0])
+    return priorities
+
+def FormatSeconds(seconds):
+    if seconds < 10:
+        return "%.1fs" % (seconds,)
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds / 3600, seconds % 3600 / 60)
+    if seconds >= 60:
+        return "%dm%02ds" % (seconds / 60, seconds % 60)
+    return "%ds" % (seconds,)
 
-        cmd = "bash build.sh"
-    else:
-        with open("build.bat", "w") as f:
-            f.write("cd %s/infr_scripts_pl/Build\n" % (container,))
-            f.write("call SetupEnv.bat\n")
-#            f.write("set PATH=%PATH%;c:\\msys64\\usr\\bin\n")    # For BISON
-            f.write("set PATH=%PATH%;c:\\strawberry\\perl\\bin\n")
-            f.write("set PATH=%PATH%;c:\\msys64\\apache-ant-1.10.12\\bin\n")
-            f.write("set JAVA_HOME=C:\\Program Files\\Eclipse Adoptium\\jdk-17.0.4.101-hotspot\n")
-            f.write("perl Build.pl DOMAINS=%s CONFIG=%s\n" % (domains, config))
-        cmd = "cmd /c build.bat"
-    print "cmd: ", cmd
-    Cmd(cmd, True)
+#
+# --plan: print the containers a build of "todo" would run, in the order they would
+# be started, with their estimated times, the estimated wall time (simulating the
+# parallel scheduler for --jobs, or the dependency order BuildSerial builds in for
+# one job) and the critical path
+#
+def Plan(todo):
+    specs = collections.OrderedDict([SplitSpec(c) for c in todo])
+    estimates = EstimateBuilds(todo)
+    default = estimates and sum(estimates.values()) / len(estimates) or 0
+    durations = dict([(c, estimates.get(c, default)) for c in specs])
+    priorities = BuildPriorities(specs, estimates)
+    sizes = ExportSizes(specs)
+
+    order = list(specs)
+    if args.jobs > 1:
+        order.sort(key=lambda c: -priorities[c])
+    waiting = collections.OrderedDict([(c, set([d for d in all_containers[c] if d in specs])) for c in order])
+    running = {}
+    started = collections.OrderedDict()
+    now = 0
+    while waiting or running:
+        for c in list(waiting):
+            if len(running) >= max(args.jobs, 1):
+                break
+            if waiting[c]:
+                continue
+            if running and args.memory_limit and \
+               sum([ContainerMemory(r) for r in running]) + ContainerMemory(c) > args.memory_limit:
+                continue
+            del waiting[c]
+            started[c] = now
+            running[c] = now + durations[c]
+        # Move on to the next container to finish
+        c = min(running, key=lambda r: running[r])
+        now = running.pop(c)
+        for w in waiting.values():
+            w.discard(c)
+
+    print "%-24s %9s %9s %9s %10s" % ("Container", "Estimate", "Start", "Finish", "Exports")
+    for c, start in started.items():
+        estimate = FormatSeconds(durations[c])
+        if c not in estimates:
+            estimate = "?" + estimate
+        size = "-"
+        if sizes.get(c):
+            size = "%.1fMB" % (sizes[c] / 1e6,)
+        print "%-24s %9s %9s %9s %10s" % (c, estimate, FormatSeconds(start), FormatSeconds(start + durations[c]), size)
+    path, length = CriticalPath(durations)
+    print "Plan: %d containers, %d at once, estimated wall time %s" % (len(started), max(args.jobs, 1), FormatSeconds(now))
+    print "Plan: critical path %s (%s)" % (" -> ".join(path), FormatSeconds(length))
+    unknown = [c for c in specs if c not in estimates]
+    if unknown:
+        print "Plan: no build history for %s (? estimates are the average)" % (" ".join(unknown),)
 
-    ## Create the tarballs for installation - find the Upload sh commands
-    os.chdir(container)
 
-    # Find only the files this container build has produced in Installs
-    if os.path.isdir("Installs_imports"):
-        # We have imported build artefacts from parent container builds
-        os.mkdir("Installs_exports")
-        if "Windows" == platform.system():
-            pathsep = "\\"
-        else:
-            pathsep = "/"
-        for dirpath, dnames, fnames in os.walk("Installs"):
-            for f in fnames:
-                # Does the file exist in the set of imports?
-                testPath = dirpath.replace("Installs", "Installs_imports") + pathsep + f
-                testPath.replace("\\", "/")
-
-                if not os.path.exists(testPath):
-                    # The file is not in the set of imports - copy it to the exports
-                    newPath = dirpath.replace("Installs", "Installs_exports")
-                    dirlist = newPath.split(pathsep)
-
-                    # This loop creates the dest dir
-                    p = ""
-                    for d in dirlist:
-                        p += d
-                        try:
-                            os.mkdir(p)
-                        except WindowsError, e:
-                            pass
-                        p += pathsep
+#
+# Run a command (in the working area unless "cwd" is given)
+#
+def Cmd(cmd, useShell=False, cwd=None):
+    Log("Running cmd: %s" % (cmd,))
+    if args.dryrun:
+        return
 
-                    # And finally copy the file to the dest dir
-                    shutil.copy(dirpath + pathsep + f, newPath)
+    if useShell or isinstance(cmd, list):
+        cmdsplit = cmd
+    else:    
+        cmdsplit = cmd.split()
 
-    elif os.path.isdir("Installs"):
-        # We did not import anything - we are a "leaf"
-        shutil.copytree("Installs", "Installs_exports")
+    with Phase("cmd", detail=str(cmd)):
+        handle = subprocess.Popen(cmdsplit, shell=useShell, cwd=cwd or Path())
 
-    os.rename("Installs", "Installs_working")
-    os.rename("Installs_exports", "Installs")
+        r = handle.wait()
+    if 0 != r:
+        raise Exception("Error %s, failed cmd: %s" % (r, cmdsplit))
 
-    with open("Jenkinsfile") as f:
-        lines = f.readlines()
 
-    current_state = "init"
-    if "PC" == DEST_HOST:
-        searching = '("Windows")'
-    else:
-        searching = '("Centos")'
+#
+# Print a message in one write, so messages from threads do not interleave
+#
+def Log(msg):
+    sys.stdout.write(msg + "\n")
+    sys.stdout.flush()
 
-    for i in range(len(lines)):
-        l = lines[i]
+#
+# Run a command and return its output (used for read-only queries such as git
+# so is run even with --dryrun)
+#
+def CmdOutput(cmd, cwd=None):
+    if not isinstance(cmd, list):
+        cmd = cmd.split()
+    return subprocess.check_output(cmd, cwd=cwd or Path())
 
-        if "init" == current_state and -1 != l.find(searching):
-            current_state = "host"
-            continue
+#
+# Return the directory holding the git repo of a container (for the flat_structure
+# containers the repo is cloned into a subdir of the container dir)
+#
+def RepoDir(container):
+    containerDir = Path(container)
+    if not os.path.exists(containerDir + "/.git"):
+        c_info = container_mapping_info.get(container)
+        if c_info and c_info.get("flat_structure"):
+            return containerDir + "/" + c_info["domain"]
+    return containerDir
 
-        if "host" == current_state and -1 != l.find('stage("Upload")'):
-            current_state = "upload"
-            continue
+#
+# Return the sha1 of a file. Hashes of large files (i.e. the export tarballs) are
+# remembered in the build cache against the file size and mtime
+#
+fileHashes = {}
+
+def FileHash(path):
+    hashFile = os.path.join(args.cache_dir, "filehashes.json")
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime]
+    path = os.path.abspath(path)
+
+    # Remembered in memory too, for --watch
+    entry = fileHashes.get(path)
+    if entry and entry[0] == stamp:
+        return entry[1]
+
+    try:
+        with open(hashFile) as f:
+            hashes = json.load(f)
+    except (IOError, ValueError):
+        hashes = {}
+
+    entry = hashes.get(path)
+    if entry and entry[0] == stamp:
+        fileHashes[path] = entry
+        return entry[1]
+
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ""):
+            h.update(chunk)
+    hashes[path] = [stamp, h.hexdigest()]
+    fileHashes[path] = hashes[path]
+
+    # Other builds may be running at the same time, so write then rename
+    if not os.path.isdir(args.cache_dir):
+        os.makedirs(args.cache_dir)
+    tmp = "%s.%d" % (hashFile, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(hashes, f)
+    os.rename(tmp, hashFile)
+
+    return h.hexdigest()
 
-        if "upload" == current_state:
-            if "PC" == DEST_HOST and -1 != lines[i].find("bat ") and -1 != lines[i].find("Microsoft"):
-                current_state = "found_pc"
-            elif -1 != lines[i].find("sh ") and -1 != lines[i].find("Linux64"):
-                current_state = "found_linux"
-            # fall through - do not continue
-
-        if "found_pc" == current_state:
-            if -1 != lines[i].find("Microsoft_xcommon"):
-                # Special case for xcommon due to the root of the tar/zip being down in Installs/%s/External/Product
-                cmd = 'tar -C Installs/%s/External/Product -czf ../exports/Microsoft_xcommon.zip .' % (DEST_HOST,)
-                Cmd(cmd, True)
-            elif -1 == lines[i].find("Microsoft_xTIMEdeployer") and -1 == lines[i].find("archiveArtifacts"):
-                # Ignore nasties like xflash Microsoft_xTIMEdeployer
-
-                # Remove Jenkins "bat" and all double quotes
-                cmd = lines[i].replace("bat ", "").strip().strip('"')
-
-                # Change zip... to tar czf
-                cmd = cmd.replace("zip -qr", "tar czf ").strip().strip('"')
-
-# TODO                if -1 == cmd.find(".tgz"):
-#                    raise Exception("Jenkinfile does not use .tgz: cmd %s" % (cmd,))
-
-                parts = cmd.split()
-                cmd = ""
-                for part in parts:
-                    if -1 != part.find(".tgz"):
-                        # Prefix with the destination dir for the tarball
-                        cmd += "../exports/" + part + " "
-#                    elif -1 != part.find("*"):
-#                        # Need to do the glob done by "zip" in the Jenkinsfile
-#                        paths = glob.glob(part)
-#                        for p in paths:
-#                            cmd += p + " "
-                    else:
-                        cmd += part + " "
-                cmd = cmd.strip()
+#
+# Add the state of the git repo (and any submodules) in "repoDir" to the hash "h":
+# the commits checked out plus a hash of any changes to tracked files and of any
+# untracked source files. Build products (Installs*, the tarballs and our own
+# .build_tools* records) are ignored.
+#
+def HashTreeState(h, repoDir):
+    h.update("HEAD %s\n" % (CmdOutput("git rev-parse HEAD", repoDir).strip(),))
+    submodules = CmdOutput("git submodule status --recursive", repoDir)
+    h.update(submodules)
+
+    repos = ["."]
+    for l in submodules.splitlines():
+        parts = l[1:].split()
+        if not l.startswith("-") and len(parts) > 1:
+            repos.append(parts[1])
+
+    for r in repos:
+        path = os.path.join(repoDir, r)
+        h.update("repo %s\n" % (r,))
+        h.update(subprocess.check_output(["git", "diff", "HEAD", "--ignore-submodules=all"], cwd=path))
+
+        untracked = subprocess.check_output(["git", "ls-files", "--others", "--exclude-standard", "-z", "--",
+                                             ".", ":(exclude)Installs*", ":(exclude)*.tgz", ":(exclude)*.tar.gz",
+                                             ":(exclude)*.zip", ":(exclude)*.meta", ":(exclude)*.part",
+                                             ":(exclude).build_tools*"], cwd=path)
+        for u in sorted(untracked.split("\0")):
+            if not u:
+                continue
+            uPath = os.path.join(path, u)
+            h.update("untracked %s\n" % (u,))
+            if os.path.isfile(uPath):
+                with open(uPath, "rb") as f:
+                    h.update(hashlib.sha1(f.read()).hexdigest())
 
-                if debugbuild:
-                    # for xc_compiler_combined:tools_xcc1_c_llvm
-                    cmd = cmd.replace("\\Release\\", "\\Debug\\")
+#
+# Return the build cache key for a container: the source state of the container,
+# the domains and config being built and the hashes of all the tarballs imported
+# from the containers it depends on
+#
+def CacheKey(container, domains, deps, config, hostPrefix, hostPostfix):
+    h = hashlib.sha1()
+    h.update("container %s\n" % (container,))
+    h.update("domains %s\n" % (",".join(sorted([d for d in domains.split(",") if d])),))
+    h.update("config %s\n" % (config,))
+    h.update("host %s %s\n" % (CurrentSession().destHost, hostPrefix))
+    h.update("format %s\n" % (ExportFormat(),))
 
-                if 0 == cmd.find("tar"):
-                    print "cmd:", cmd
-                    Cmd(cmd, True)
+    HashTreeState(h, RepoDir(container))
+    h.update("imports %s\n" % (ImportsHash(container, deps, hostPrefix, hostPostfix),))
 
-        elif "found_linux" == current_state:
-            if -1 != lines[i].find("Linux64_xcommon") and -1 == lines[i].find("archiveArtifacts"):
-                # Special case for xcommon
-                cmd = 'tar -C Installs/%s/External/Product -czf ../exports/Linux64_xcommon.tgz .' % (DEST_HOST,)
-                Cmd(cmd, True)
-            elif -1 == lines[i].find("Linux64_xTIMEdeployer"):
-                # Ignore nasties like xflash Linux64_xTIMEdeployer
-                cmd = lines[i].replace("sh ", "").strip().strip('"')
-
-# TODO               if -1 == cmd.find(".tgz"):
-#                    raise Exception("Jenkinfile does not have .tgz: cmd %s" % (cmd,))
-
-                parts = cmd.split()
-                cmd = ""
-                for part in parts:
-                    if -1 != part.find(".tgz"):
-                        # Prefix with the destination dir for the tarball
-                        cmd += "../exports/" + part + " "
-#                    elif -1 != part.find("*"):
-#                        # Need to do the glob done by "zip" in the Jenkinsfile
-#                        paths = glob.glob(part)
-#                        for p in paths:
-#                            cmd += p + " "
-                    else:
-                        cmd += part + " "
-                cmd = cmd.strip()
+    return h.hexdigest()
 
-                if debugbuild:
-                    # for xc_compiler_combined:tools_xcc1_c_llvm
-                    cmd = cmd.replace("/Release/", "/Debug/")
+#
+# Return a hash of all the tarballs a build of "container" uses: those exported by
+# "deps" and those downloaded from Jenkins into the container (by --clone/--update)
+#
+def ImportsHash(container, deps, hostPrefix, hostPostfix):
+    h = hashlib.sha1()
+    for d in deps:
+        for g in container_exports[d]:
+            fileName = "exports/" + g % (hostPrefix, hostPostfix)
+            if os.path.exists(Path(fileName)):
+                h.update("import %s %s\n" % (fileName, FileHash(Path(fileName))))
+            else:
+                h.update("import %s missing\n" % (fileName,))
 
-                if 0 == cmd.find("tar"):
-                    print "cmd:", cmd
-                    Cmd(cmd, True)
+    if os.path.exists(Path(container, "Jenkinsfile")):
+        for t, url in Artifacts(container):
+            if os.path.exists(Path(container, t)):
+                h.update("artifact %s %s\n" % (t, FileHash(Path(container, t))))
+            else:
+                h.update("artifact %s missing\n" % (t,))
+    return h.hexdigest()
 
-        if ("found_pc" == current_state or "found_linux" == current_state) and -1 != lines[i].strip().find("}"):
-            # Done all upload commands
-            current_state = "done"
-            break
+#
+# Return a hash of the source state of a domain within a container, or None if it
+# cannot be found. A domain which is a repo (or submodule) of its own is hashed as
+# a whole, otherwise the part of the container repo in the domain dir is.
+#
+def DomainState(container, domain):
+    path = Path(container, domain)
+    h = hashlib.sha1()
+    try:
+        if os.path.exists(os.path.join(path, ".git")):
+            HashTreeState(h, path)
+        else:
+            repo = RepoDir(container)
+            rel = os.path.relpath(path, repo).replace("\\", "/")
+            h.update(CmdOutput(["git", "rev-parse", "HEAD:" + rel], repo))
+            h.update(CmdOutput(["git", "diff", "HEAD", "--", rel], repo))
+            for u in sorted(CmdOutput(["git", "ls-files", "--others", "--exclude-standard", "-z", "--", rel], repo).split("\0")):
+                if u and os.path.isfile(os.path.join(repo, u)):
+                    h.update("untracked %s %s\n" % (u, HashFile(os.path.join(repo, u))))
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return h.hexdigest()
 
-    os.rename("Installs", "Installs_exports")
-    os.rename("Installs_working", "Installs")
- 
-    os.chdir("..")
+#
+# For --incremental: return the domains (from "domains") which have changed since
+# they were last built, plus those which depend on them, and the current state of
+# each domain to record once the build has succeeded. All the domains are returned
+# if the changes cannot be determined (no record of a previous build of this
+# config, the imports have changed, or a domain state cannot be found).
+#
+def IncrementalDomains(container, domains, config, importsHash):
+    states = {"imports" : importsHash, "domains" : {}}
+    for d in domains:
+        states["domains"][d] = DomainState(container, d)
+
+    try:
+        with open(Path(container, ".build_tools_domains.json")) as f:
+            previous = json.load(f).get(config)
+    except (IOError, ValueError):
+        previous = None
+
+    if not previous:
+        print "Build: --incremental: no record of a previous %s build of %s, building all domains" % (config, container)
+        return domains, states
+    if previous["imports"] != importsHash:
+        print "Build: --incremental: the imports of %s have changed, building all domains" % (container,)
+        return domains, states
+    if None in states["domains"].values():
+        print "Build: --incremental: cannot find the state of all the domains of %s, building all domains" % (container,)
+        return domains, states
+
+    changed = [d for d in domains if previous["domains"].get(d) != states["domains"][d]]
+
+    # Add the domains depending (directly or otherwise) on the changed ones
+    selected = set(changed)
+    dependencies = domain_dependencies.get(container)
+    for d in domains:
+        if dependencies is None:
+            if selected and domains.index(d) > min([domains.index(c) for c in changed]):
+                selected.add(d)
+        elif [p for p in dependencies.get(d, ()) if p in selected]:
+            selected.add(d)
+
+    print "Build: --incremental: changed domains %s, building %s" % (changed, [d for d in domains if d in selected])
+    return [d for d in domains if d in selected], states
 
+#
+# Record the domain states of a successful build for --incremental
+#
+def SaveDomainStates(container, config, states):
+    fileName = Path(container, ".build_tools_domains.json")
+    try:
+        with open(fileName) as f:
+            saved = json.load(f)
+    except (IOError, ValueError):
+        saved = {}
+    saved[config] = states
+    with open(fileName, "w") as f:
+        json.dump(saved, f, indent=1)
 
-def Unpack(container, updateOnly):
-    base = "http://srv-bri-jtools:8080%s/lastSuccessfulBuild/artifact/%s"
-    flat = False
-    tools_dir = container
+#
+# Create "dst" as a hard link or reflink (copy-on-write clone) of "src", or a copy
+# of it, trying each method in "modes" in turn and returning the one used.
+# Symbolic links are recreated.
+#
+FICLONE = 0x40049409
 
-    if not updateOnly:
-        # Do a full clone
+def LinkFile(src, dst, modes=("hardlink", "reflink", "copy")):
+    if os.path.lexists(dst):
+        os.remove(dst)
 
-        c_info = container_mapping_info.get(container)
-        if c_info:
-            domain = c_info.get("domain")
-            if domain:
-                tools_dir = domain
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+        return "symlink"
 
-            flat = c_info.get("flat_structure")
+    for mode in modes:
+        try:
+            if "hardlink" == mode:
+                os.link(src, dst)
+            elif "reflink" == mode:
+                import fcntl
+                with open(src, "rb") as s:
+                    with open(dst, "wb") as d:
+                        try:
+                            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                        except IOError:
+                            os.remove(dst)
+                            raise
+                shutil.copystat(src, dst)
+            else:
+                shutil.copy2(src, dst)
+            return mode
+        except (OSError, IOError, AttributeError, ImportError):
+            if mode == modes[-1]:
+                raise
 
-            if flat:
-               os.mkdir(container)
-               os.chdir(container)
+#
+# Return {path : (size, mtime, ctime)} for all the files under "top", with paths
+# relative to "top" using "/" separators. Symbolic links to dirs are not walked but
+# are included as files.
+#
+def StatTree(top):
+    tree = {}
+    for dirpath, dnames, fnames in os.walk(top):
+        rel = os.path.relpath(dirpath, top).replace("\\", "/")
+        for f in fnames + [d for d in dnames if os.path.islink(os.path.join(dirpath, d))]:
+            st = os.lstat(os.path.join(dirpath, f))
+            if "." == rel:
+                tree[f] = (st.st_size, st.st_mtime, st.st_ctime)
+            else:
+                tree[rel + "/" + f] = (st.st_size, st.st_mtime, st.st_ctime)
+    return tree
 
-        path = "git@github0.xmos.com:xmos-int/%s %s" % (container, tools_dir)
-        Cmd("git clone --recurse-submodules %s" % (path,))
+def HashFile(path):
+    h = hashlib.sha1()
+    if os.path.islink(path):
+        h.update(os.readlink(path))
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ""):
+                h.update(chunk)
+    return h.hexdigest()
 
-        if flat:
-#           os.chdir("..")
-           # Create for the Build fn which needs to extract the "upload entries"
-           if platform.platform().find("Windows") != -1:
-               shutil.copy(tools_dir + "/Jenkinsfile", "Jenkinsfile")
-           else:
-               os.symlink(tools_dir + "/Jenkinsfile", "Jenkinsfile")
-           os.chdir("..")
+#
+# Populate Installs_exports with the files in Installs which were not imported, or
+# which the build has changed since they were imported, in one pass over Installs.
+# The files are linked rather than copied where possible.
+#
+def ExportInstalls(containerDir):
+    installs = os.path.join(containerDir, "Installs")
+    exports = os.path.join(containerDir, "Installs_exports")
+
+    try:
+        with open(os.path.join(containerDir, "Installs_imports.json")) as f:
+            manifest = json.load(f)
+    except IOError:
+        # We did not import anything - we are a "leaf"
+        manifest = {}
+
+    os.mkdir(exports)
+    count = 0
+    for dirpath, dnames, fnames in os.walk(installs):
+        rel = os.path.relpath(dirpath, installs)
+        relKey = rel.replace("\\", "/")
+        created = False
+
+        # Symbolic links to dirs are not walked, so handle them as files
+        for f in fnames + [d for d in dnames if os.path.islink(os.path.join(dirpath, d))]:
+            src = os.path.join(dirpath, f)
+            if "." == relKey:
+                key = f
+            else:
+                key = relKey + "/" + f
 
-    print("cwd: %s, tools_dir %s\n" % (os.getcwd(), tools_dir))
+            imported = manifest.get(key)
+            if imported:
+                st = os.lstat(src)
+                if st.st_size == imported[0] and (st.st_mtime == imported[1] or HashFile(src) == imported[2]):
+                    # Unchanged since it was imported
+                    continue
 
-    os.chdir(container)
-    with open("Jenkinsfile") as f:
-        lines = f.readlines()
+            if not created:
+                # Create each dest dir once
+                dest = os.path.normpath(os.path.join(exports, rel))
+                if not os.path.isdir(dest):
+                    os.makedirs(dest)
+                created = True
+            LinkFile(src, os.path.join(dest, f))
+            count += 1
 
-    for l in lines:
-        if -1 != l.find("copyArtifacts"):
-            parts = l.split()
+    print "Build: %d new or changed files exported from %s" % (count, installs)
 
-            print "l:", l, " parts:", parts
+#
+# If the build cache has the exports for "cacheKey" put them in working/exports and return True
+#
+def RestoreFromCache(container, cacheKey, hostPrefix, hostPostfix):
+    cacheDir = os.path.join(args.cache_dir, cacheKey)
+    names = [g % (hostPrefix, hostPostfix) for g in container_exports[container]]
+
+    for n in names:
+        if not os.path.exists(os.path.join(cacheDir, n)):
+            if not args.shared_cache or not SharedCacheGet(cacheKey, names, cacheDir):
+                print "Build: no cached build of %s (key %s)" % (container, cacheKey)
+                return False
+            break
 
-            for i in range(len(parts)):
-                if parts[i] == "filter:":
-                    filter = parts[i+1].strip("',")
-                if parts[i] == "projectName:":
-                    projectName = parts[i+1].strip("',")
+    print "Build: restoring %s from the build cache (key %s), skipping Build.pl" % (container, cacheKey)
+    for n in names:
+        LinkFile(os.path.join(cacheDir, n), Path("exports", n))
+    # Mark the entry as used
+    os.utime(os.path.join(cacheDir, "info.json"), None)
+    EvictCache(cacheDir)
+    return True
 
-            if -1 == filter.find("Linux64"):
-                continue
+#
+# Record the exports just built for a container against "cacheKey"
+#
+def SaveToCache(container, cacheKey, hostPrefix, hostPostfix):
+    cacheDir = os.path.join(args.cache_dir, cacheKey)
+    names = [g % (hostPrefix, hostPostfix) for g in container_exports[container]]
+
+    for n in names:
+        if not os.path.exists(Path("exports", n)):
+            print "Build: not caching %s as exports/%s was not created" % (container, n)
+            return
+
+    # Populate a temporary dir and rename it, so a partial entry is never used
+    tmpDir = "%s.%d" % (cacheDir, os.getpid())
+    shutil.rmtree(tmpDir, True)
+    os.makedirs(tmpDir)
+    for n in names:
+        LinkFile(Path("exports", n), os.path.join(tmpDir, n))
+    with open(os.path.join(tmpDir, "info.json"), "w") as f:
+        json.dump({"container" : container, "exports" : names, "time" : time.time()}, f)
+
+    shutil.rmtree(cacheDir, True)
+    os.rename(tmpDir, cacheDir)
+    print "Build: cached exports of %s (key %s)" % (container, cacheKey)
+    EvictCache(cacheDir)
+
+    if args.shared_cache and not args.no_shared_push:
+        SharedCachePut(cacheKey, names, cacheDir)
+
+    if not args.no_artifact_store and os.path.isdir(args.artifact_store):
+        for n in names:
+            StoreInsert(os.path.join(cacheDir, n), {"tarball" : n, "job" : "local/%s" % (container,), "build" : cacheKey})
 
-            tarballs = []
-            if -1 == filter.find("*"):
-                tarballs.append(filter)
-            else:
-                # Hack - a * at the end of the tarball name implies Installs and private
-                f = filter.replace("*", "Installs")
-                tarballs.append(f)
-                f = filter.replace("*", "private")
-                tarballs.append(f)
+#
+# Remove the least recently used entries of the build cache (other than "keep")
+# until it is under --cache-size GB. Each entry hard links the exports of a build,
+# which the next build of the container replaces, so without this every export
+# ever built would be kept. The mtime of an entry's info.json is its last use.
+#
+def EvictCache(keep):
+    maxBytes = int(args.cache_size * 1024 * 1024 * 1024)
+    entries = []
+    total = 0
+    for key in os.listdir(args.cache_dir):
+        entryDir = os.path.join(args.cache_dir, key)
+        if not re.match(r"^[0-9a-f]{40}$", key):
+            # filehashes.json, the Jenkinsfile models and entries being created
+            continue
+        try:
+            used = os.path.getmtime(os.path.join(entryDir, "info.json"))
+            size = sum([os.path.getsize(os.path.join(entryDir, n)) for n in os.listdir(entryDir)])
+        except OSError:
+            continue
+        total += size
+        if entryDir != keep:
+            entries.append((used, entryDir, size))
 
-            for t in tarballs:
-                project_parts = projectName.split("/")
+    for used, entryDir, size in sorted(entries):
+        if total <= maxBytes:
+            break
+        Log("Build cache: evicting %s (%d bytes)" % (os.path.basename(entryDir), size))
+        shutil.rmtree(entryDir, True)
+        total -= size
 
-                subpath = ""
-                for p in project_parts:
-                    subpath += "/job/%s" % (p,)
+#
+# Shared build cache.
+#
+# With --shared-cache the exports of each build are also pushed to a cache shared
+# by a team (and CI), and pulled from it on a local cache miss, so a container
+# revision is only built once. The store is either a directory (e.g. on NFS) or an
+# HTTP server accepting GET and PUT (see --serve-cache).
+#
+# Each entry is <store>/<key>/ holding the tarballs and a manifest.json of their
+# sizes and sha256 hashes. The manifest is written last so an entry is only used
+# once complete, and downloaded tarballs are checked against it. The store is kept
+# under --shared-cache-size GB by removing the least recently used entries (the
+# manifest mtime is updated on each use).
+#
+def Sha256File(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ""):
+            h.update(chunk)
+    return h.hexdigest()
 
-                path = base % (subpath, t)
+def IsHttp(url):
+    return url.startswith("http://") or url.startswith("https://")
 
-                # Move the extsing tarball to a .1 backup otherwise wget will create the new one as <fname>.1
-                if os.path.exists(t):
-                    Cmd("mv %s %s.1" % (t, t,))
+#
+# Copy the stream "src" to the file "dest", checking its sha256 and size
+#
+def CopyVerified(src, dest, entry):
+    h = hashlib.sha256()
+    size = 0
+    with open(dest, "wb") as f:
+        for chunk in iter(lambda: src.read(1024 * 1024), ""):
+            h.update(chunk)
+            size += len(chunk)
+            f.write(chunk)
+    if h.hexdigest() != entry["sha256"] or size != entry["size"]:
+        os.remove(dest)
+        raise Exception("%s does not match the shared cache manifest" % (dest,))
 
-                Cmd("wget %s" % (path,))
+#
+# Fetch the entry "key" from the shared cache into the local cache dir "cacheDir".
+# Returns False if the shared cache does not have it (or it is corrupt).
+#
+def SharedCacheGet(key, names, cacheDir):
+    store = args.shared_cache
+    tmpDir = "%s.%d" % (cacheDir, os.getpid())
+    shutil.rmtree(tmpDir, True)
+    os.makedirs(tmpDir)
+
+    try:
+        if IsHttp(store):
+            resp = HttpRequest("%s/%s/manifest.json" % (store.rstrip("/"), key), {})
+            if 200 != resp.status:
+                resp.read()
+                return False
+            manifest = json.loads(resp.read())
+        else:
+            try:
+                with open(os.path.join(store, key, "manifest.json")) as f:
+                    manifest = json.load(f)
+            except (IOError, ValueError):
+                return False
+            # Mark as recently used
+            os.utime(os.path.join(store, key, "manifest.json"), None)
+
+        if [n for n in names if n not in manifest["files"]]:
+            return False
+
+        print "Build: fetching %s from the shared cache %s" % (key, store)
+        for n in names:
+            if IsHttp(store):
+                resp = HttpRequest("%s/%s/%s" % (store.rstrip("/"), key, n), {})
+                if 200 != resp.status:
+                    resp.read()
+                    raise Exception("Error %s fetching %s from the shared cache" % (resp.status, n))
+                CopyVerified(resp, os.path.join(tmpDir, n), manifest["files"][n])
+            else:
+                with open(os.path.join(store, key, n), "rb") as src:
+                    CopyVerified(src, os.path.join(tmpDir, n), manifest["files"][n])
+
+        with open(os.path.join(tmpDir, "info.json"), "w") as f:
+            json.dump({"container" : manifest.get("container"), "exports" : names, "time" : time.time(), "shared" : store}, f)
+        shutil.rmtree(cacheDir, True)
+        os.rename(tmpDir, cacheDir)
+        return True
+    except Exception, e:
+        print "Build: failed to fetch %s from the shared cache: %s" % (key, e)
+        return False
+    finally:
+        shutil.rmtree(tmpDir, True)
 
-                if "Linux64_xcommon.tgz" == t:
-                    Cmd("sh -c 'mkdir -p Installs/Linux/External/Product && tar -x -C Installs/Linux/External/Product -f Linux64_xcommon.tgz'", True)
-                elif "Linux64_xclang_Installs.tar.gz" == t:
-                    Cmd("sh -c 'tar -C Installs/Linux/External/Product -xzf Linux64_xclang_Installs.tar.gz --strip-components=2'", True)
+#
+# Push the local cache entry in "cacheDir" to the shared cache as "key"
+#
+def SharedCachePut(key, names, cacheDir):
+    store = args.shared_cache
+    manifest = {"files" : {}, "time" : time.time()}
+    with open(os.path.join(cacheDir, "info.json")) as f:
+        manifest["container"] = json.load(f).get("container")
+    for n in names:
+        path = os.path.join(cacheDir, n)
+        manifest["files"][n] = {"sha256" : Sha256File(path), "size" : os.path.getsize(path)}
+
+    print "Build: pushing %s to the shared cache %s" % (key, store)
+    try:
+        if IsHttp(store):
+            for n in names + ["manifest.json"]:
+                url = urlparse.urlsplit("%s/%s/%s" % (store.rstrip("/"), key, n))
+                conn = httplib.HTTPConnection(url.netloc, timeout=60)
+                if "manifest.json" == n:
+                    conn.request("PUT", url.path, json.dumps(manifest))
                 else:
-                    Cmd("sh -c 'tar -xf %s'" % (t,), True)
-
-                # Remove the backup .1 file
-                if os.path.exists("%s.1" % (t,)):
-                    Cmd("rm %s.1" % (t,))
+                    with open(os.path.join(cacheDir, n), "rb") as f:
+                        conn.request("PUT", url.path, f, {"Content-Length" : str(os.path.getsize(os.path.join(cacheDir, n)))})
+                resp = conn.getresponse()
+                resp.read()
+                conn.close()
+                if resp.status not in (200, 201, 204):
+                    raise Exception("Error %s %s putting %s" % (resp.status, resp.reason, n))
+        else:
+            StorePut(store, key, manifest, dict([(n, os.path.join(cacheDir, n)) for n in names]),
+                     int(args.shared_cache_size * 1024 * 1024 * 1024))
+    except Exception, e:
+        # The shared cache is an optimisation - failing to update it is not a build failure
+        print "Build: failed to push %s to the shared cache: %s" % (key, e)
 
-    os.chdir("..")
+#
+# Whether "name" can be the name of a file in a store entry (it cannot leave the entry)
+#
+def StoreName(name):
+    return re.match(r"^[\w.+-]+$", name) and name not in (".", "..")
 
-    if not os.path.exists("%s/infr_scripts_pl" % (container,)):
-        Cmd("cd %s && git clone git@github.com:xmos/infr_scripts_pl" % (container,), True)
+#
+# Add an entry to a directory store. "files" maps names to the files to copy in.
+# The store is then kept under "maxBytes".
+#
+def StorePut(store, key, manifest, files, maxBytes):
+    for n in manifest["files"]:
+        if not StoreName(n) or "manifest.json" == n:
+            raise Exception("Invalid file name %r in the manifest" % (n,))
+    entryDir = os.path.join(store, key)
+    tmpDir = "%s.tmp%d.%d" % (entryDir, os.getpid(), threading.current_thread().ident)
+    shutil.rmtree(tmpDir, True)
+    os.makedirs(tmpDir)
+    try:
+        for n, path in files.items():
+            with open(path, "rb") as src:
+                CopyVerified(src, os.path.join(tmpDir, n), manifest["files"][n])
+        with open(os.path.join(tmpDir, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+        if os.path.exists(entryDir):
+            shutil.rmtree(entryDir, True)
+        os.rename(tmpDir, entryDir)
+    finally:
+        shutil.rmtree(tmpDir, True)
+    EvictStore(store, maxBytes)
 
-    # Hack for xmap
-    if not os.path.exists("%s/tools_bin2header" % (container,)):
-        Cmd("cd %s && git clone git@github.com:xmos/bin2header tools_bin2header" % (container,), True)
-
-def Git(container, cmd):
-    os.chdir(container)
-    if os.path.exists(".git"):
-        Cmd("git status")
-        Cmd("git submodule foreach git status")
-    elif container_mapping_info[container]["flat_structure"]:
-        os.chdir(container_mapping_info[container]["domain"])
-        Cmd("git status")
-        os.chdir("..")
-    os.chdir("..")
+#
+# Remove the least recently used entries of a directory store until it is under "maxBytes"
+#
+def EvictStore(store, maxBytes):
+    entries = []
+    total = ExpireUploads(store)
+    for key in os.listdir(store):
+        manifest = os.path.join(store, key, "manifest.json")
+        if not os.path.exists(manifest):
+            continue
+        size = sum([os.path.getsize(os.path.join(store, key, n)) for n in os.listdir(os.path.join(store, key))])
+        entries.append((os.path.getmtime(manifest), key, size))
+        total += size
 
-import platform
-if platform.system() != "Windows" or os.environ.get('MSYSTEM') != None:
-    # Building On Linux (for Linux) or on MINGW for PC
-    BUILD_HOST = "Linux"
-else:
-    BUILD_HOST = "PC"
+    for used, key, size in sorted(entries):
+        if total <= maxBytes:
+            break
+        print "Shared cache: evicting %s (%d bytes)" % (key, size)
+        shutil.rmtree(os.path.join(store, key), True)
+        total -= size
 
+#
+# Remove the uploads to the server of a store (see SharedCacheHandler) which have
+# not been added to it for UPLOAD_EXPIRY seconds, and return the size of the rest
+#
+UPLOAD_EXPIRY = 3600
+
+def ExpireUploads(store):
+    uploads = os.path.join(store, ".uploads")
+    if not os.path.isdir(uploads):
+        return 0
+    total = 0
+    for key in os.listdir(uploads):
+        uploadDir = os.path.join(uploads, key)
+        try:
+            files = [os.stat(os.path.join(uploadDir, n)) for n in os.listdir(uploadDir)]
+            last = max([os.path.getmtime(uploadDir)] + [st.st_mtime for st in files])
+        except OSError:
+            continue
+        if time.time() - last > UPLOAD_EXPIRY:
+            print "Shared cache: removing the incomplete upload %s" % (key,)
+            shutil.rmtree(uploadDir, True)
+        elif not os.path.exists(os.path.join(store, key, "manifest.json")):
+            # (Once the entry is in the store its upload is about to be removed)
+            total += sum([st.st_size for st in files])
+    return total
 
-if os.environ.get('SYSTEMDRIVE'):
-    # Building on Windows (for Windows) or on MINGW64 for Windows
-    DEST_HOST = "PC"
-else:
-    DEST_HOST = "Linux"
+#
+# HTTP server for a shared cache in directory "store" (--serve-cache).
+# GET /<key>/<name> fetches a file, PUT /<key>/<name> uploads one. Uploads are
+# held until the PUT of the manifest.json, when they are checked against it and
+# the entry is added to the store (evicting the least recently used). Uploads
+# count against the size of the store, and are removed if they are not completed
+# within UPLOAD_EXPIRY. They are not authenticated, so it listens on localhost
+# unless --serve-address is given.
+#
+class SharedCacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def Path(self):
+        parts = self.path.strip("/").split("/")
+        if 2 != len(parts) or not re.match(r"^[0-9a-f]{40}$", parts[0]) or not StoreName(parts[1]):
+            return None
+        return parts
+
+    def Reply(self, status, body=""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = self.Path()
+        store = self.server.store
+        if not parts or not os.path.exists(os.path.join(store, parts[0], "manifest.json")):
+            return self.Reply(404)
+        path = os.path.join(store, *parts)
+        if not os.path.isfile(path):
+            return self.Reply(404)
+        if "manifest.json" == parts[1]:
+            # Mark as recently used
+            os.utime(path, None)
+
+        self.send_response(200)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+    def do_PUT(self):
+        parts = self.Path()
+        if not parts:
+            return self.Reply(400)
+        key, name = parts
+        length = int(self.headers.getheader("content-length", 0))
+        # (The manifest is not held with the uploads, so only they count)
+        if length > self.server.maxBytes or ("manifest.json" != name and ExpireUploads(self.server.store) + length > self.server.maxBytes):
+            # The body is not read, so the connection cannot be reused
+            self.close_connection = 1
+            return self.Reply(413, "The upload is larger than the cache")
+        uploadDir = os.path.join(self.server.store, ".uploads", key)
+        if not os.path.isdir(uploadDir):
+            os.makedirs(uploadDir)
+
+        if "manifest.json" != name:
+            with open(os.path.join(uploadDir, name), "wb") as f:
+                while length:
+                    chunk = self.rfile.read(min(length, 1024 * 1024))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    length -= len(chunk)
+            return self.Reply(201)
 
-args = ParseArgs()
+        try:
+            # The names are checked (by StorePut) before any file is read
+            manifest = json.loads(self.rfile.read(length))
+            StorePut(self.server.store, key, manifest, dict([(n, os.path.join(uploadDir, n)) for n in manifest["files"]]),
+                     self.server.maxBytes)
+        except Exception, e:
+            return self.Reply(400, str(e))
+        finally:
+            shutil.rmtree(uploadDir, True)
+        self.Reply(201)
+
+class SharedCacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def ServeSharedCache(store, address, port, maxGB):
+    if not os.path.isdir(store):
+        os.makedirs(store)
+    server = SharedCacheServer((address, port), SharedCacheHandler)
+    server.store = store
+    server.maxBytes = int(maxGB * 1024 * 1024 * 1024)
+    EvictStore(store, server.maxBytes)
+    print "Serving shared cache %s on %s port %d" % (store, address, port)
+    server.serve_forever()
 
 
-if args.clone and args.mkroot: 
-    os.mkdir("working")
-    os.mkdir("working/exports")
+#
+# Tarball creation and extraction.
+#
+# The "archiver" selects how this is done:
+#   tar    - GNU tar, as in the Jenkinsfiles
+#   python - in-process with the tarfile module
+#   pigz   - tar piped through pigz using --archive-jobs threads (gzip, so matches Jenkins)
+#   zstd   - tar piped through zstd using --archive-jobs threads. Only for tarballs
+#            used locally - the files keep their .tgz names so downstream containers find them
+# Extraction detects the compression from the file contents so any archiver
+# can extract a tarball created by any other.
+#
+GZIP_MAGIC = "\x1f\x8b"
+ZSTD_MAGIC = "\x28\xb5\x2f\xfd"
+
+def FindProgram(name):
+    for p in os.environ.get("PATH", "").split(os.pathsep):
+        if os.path.isfile(os.path.join(p, name)) and os.access(os.path.join(p, name), os.X_OK):
+            return os.path.join(p, name)
+    return None
+
+def Archiver():
+    if "auto" == args.archiver:
+        if FindProgram("pigz"):
+            return "pigz"
+        return "tar"
+    if args.archiver in ("pigz", "zstd") and not FindProgram(args.archiver):
+        raise Exception("--archiver %s: %s is not installed" % (args.archiver, args.archiver))
+    return args.archiver
+
+def Compressor(archiver, decompress):
+    if "pigz" == archiver:
+        cmd = ["pigz", "-p", str(args.archive_jobs)]
+    elif "zstd" == archiver:
+        cmd = ["zstd", "-q", "-T%d" % (args.archive_jobs,)]
+    else:
+        cmd = ["gzip"]
+    if decompress:
+        cmd.append("-dc")
+    return cmd
 
-os.chdir("working")
+#
+# Run a pipeline of two commands, writing the output of the last to "outFile"
+#
+def Pipeline(first, second, cwd=None, outFile=None):
+    Log("Running cmd: %s | %s" % (" ".join(first), " ".join(second)))
+    out = None
+    if outFile:
+        out = open(outFile, "wb")
+    try:
+        with Phase("cmd", detail="%s | %s" % (" ".join(first), " ".join(second))):
+            p1 = subprocess.Popen(first, cwd=cwd, stdout=subprocess.PIPE)
+            p2 = subprocess.Popen(second, cwd=cwd, stdin=p1.stdout, stdout=out)
+            p1.stdout.close()
+            r2 = p2.wait()
+            r1 = p1.wait()
+    finally:
+        if out:
+            out.close()
+    if r1 or r2:
+        raise Exception("Error %s/%s, failed cmd: %s | %s" % (r1, r2, first, second))
+
+#
+# Extract "tarball" into the directory "dest", removing the first "strip" components of each path
+#
+def ExtractArchive(tarball, dest, strip=0):
+    Log("Extracting %s into %s" % (tarball, dest))
+    if args.dryrun:
+        return
+
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+
+    with open(tarball, "rb") as f:
+        magic = f.read(4)
+    archiver = Archiver()
+
+    if "python" == archiver:
+        proc = None
+        if magic.startswith(ZSTD_MAGIC):
+            # tarfile cannot decompress zstd itself
+            proc = subprocess.Popen(Compressor("zstd", True) + [tarball], stdout=subprocess.PIPE)
+            tar = tarfile.open(fileobj=proc.stdout, mode="r|")
+        else:
+            tar = tarfile.open(tarball, "r|*")
+
+        def stripped(name):
+            parts = name.split("/")[strip:]
+            if not parts or not parts[0]:
+                return None
+            return "/".join(parts)
+
+        # Paths must stay within "dest" (GNU tar also refuses to write outside it)
+        def unsafe(name):
+            return name.startswith("/") or ".." in name.split("/")
+
+        dirs = []
+        for member in tar:
+            if strip:
+                member.name = stripped(member.name)
+                if member.name is None:
+                    continue
+                if member.islnk():
+                    member.linkname = stripped(member.linkname)
+                    if member.linkname is None:
+                        continue
+            if unsafe(member.name) or (member.islnk() and unsafe(member.linkname)):
+                raise Exception("%s: refusing to extract %s outside %s" % (tarball, member.name, dest))
+            target = os.path.join(dest, member.name)
+            if member.isdir():
+                dirs.append(member)
+            elif os.path.lexists(target) and not os.path.isdir(target):
+                # Replace rather than overwrite, as the file may be linked elsewhere (as tar does)
+                os.remove(target)
+            tar.extract(member, dest)
+        tar.close()
+
+        # Directory times are set once their contents have been written
+        for member in dirs:
+            tar.utime(member, os.path.join(dest, member.name))
+
+        if proc and proc.wait():
+            raise Exception("Error %s, failed to decompress %s" % (proc.returncode, tarball))
+        return
+
+    # Lists, not strings to be split, as the paths may contain spaces
+    options = []
+    if strip:
+        options.append("--strip-components=%d" % (strip,))
+
+    if magic.startswith(ZSTD_MAGIC):
+        Pipeline(Compressor("zstd", True) + [tarball], ["tar", "-C", dest, "-xf", "-"] + options)
+    elif magic.startswith(GZIP_MAGIC) and "pigz" == archiver:
+        Pipeline(Compressor("pigz", True) + [tarball], ["tar", "-C", dest, "-xf", "-"] + options)
+    else:
+        Cmd(["tar", "-C", dest, "-xf", tarball] + options)
+
+#
+# The compression of the tarballs a build exports: gzip, as Jenkins', unless zstd
+# (much faster, but only readable by this script) is chosen with --archiver zstd
+#
+def ExportFormat():
+    if "zstd" == args.archiver:
+        return "zstd"
+    return "gzip"
+
+#
+# Expand the wildcards in "members" (paths relative to "cwd") as the shell running
+# the Jenkinsfile command would
+#
+def ExpandMembers(members, cwd):
+    names = []
+    for m in members:
+        if [c for c in "*?[" if c in m]:
+            names += [os.path.relpath(e, cwd) for e in sorted(glob.glob(os.path.join(cwd, m)))]
+        else:
+            names.append(os.path.normpath(m))
+    return names
+
+tarOwners = {}
+
+#
+# Return a TarInfo for "path" named "arcname" from its lstat "st" (as TarFile.gettarinfo()
+# would, without another stat), or None for a file type tar does not archive
+#
+def MakeTarInfo(path, arcname, st):
+    ti = tarfile.TarInfo(arcname)
+    ti.mode = stat.S_IMODE(st.st_mode)
+    ti.uid = st.st_uid
+    ti.gid = st.st_gid
+    ti.mtime = int(st.st_mtime)
+    if stat.S_ISREG(st.st_mode):
+        ti.type = tarfile.REGTYPE
+        ti.size = st.st_size
+    elif stat.S_ISDIR(st.st_mode):
+        ti.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        ti.type = tarfile.SYMTYPE
+        ti.linkname = os.readlink(path)
+    else:
+        return None
+
+    if not tarOwners.has_key((st.st_uid, st.st_gid)):
+        owner = group = ""
+        try:
+            import grp, pwd
+            owner = pwd.getpwuid(st.st_uid)[0]
+            group = grp.getgrgid(st.st_gid)[0]
+        except (ImportError, KeyError):
+            pass
+        tarOwners[(st.st_uid, st.st_gid)] = (owner, group)
+    ti.uname, ti.gname = tarOwners[(st.st_uid, st.st_gid)]
+    return ti
+
+#
+# An export tarball being written by a thread: the entries routed to it are queued
+# and written into a tar stream, compressed either by a pigz/gzip/zstd process or
+# in-process with zlib (which runs without the GIL), so all the tarballs of a
+# container are compressed at the same time.
+#
+class ArchiveWriter(object):
+    def __init__(self, tarball, roots, format):
+        self.tarball = tarball
+        self.roots = roots
+        self.tmp = "%s.tmp%d" % (tarball, os.getpid())
+        self.queue = Queue.Queue()
+        self.inodes = {}
+        self.error = None
+
+        self.out = open(self.tmp, "wb")
+        self.proc = None
+        archiver = Archiver()
+        if "zstd" == format:
+            self.proc = subprocess.Popen(Compressor("zstd", False), stdin=subprocess.PIPE, stdout=self.out)
+            self.stream = self.proc.stdin
+        elif archiver in ("pigz", "tar"):
+            self.proc = subprocess.Popen(Compressor(archiver, False), stdin=subprocess.PIPE, stdout=self.out)
+            self.stream = self.proc.stdin
+        else:
+            # Level 6 as gzip uses by default (tarfile would use 9, which is much slower)
+            self.stream = gzip.GzipFile("", "wb", 6, self.out, 0)
+        self.thread = threading.Thread(target=self.Run)
+        self.thread.start()
+
+    #
+    # Queue "path" (whose lstat is "st") if it is under one of this tarball's members
+    #
+    def Route(self, path, st):
+        for root, name in self.roots:
+            if path == root:
+                arcname = name
+            elif path.startswith(root + os.sep):
+                arcname = name + path[len(root):].replace(os.sep, "/")
+            else:
+                continue
+            self.queue.put((path, arcname, st))
+            return
+
+    def Run(self):
+        try:
+            tar = tarfile.open(fileobj=self.stream, mode="w|", format=tarfile.GNU_FORMAT)
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                path, arcname, st = item
+                ti = MakeTarInfo(path, arcname, st)
+                if ti is None:
+                    continue
+                if tarfile.REGTYPE == ti.type and st.st_nlink > 1:
+                    # Hard links within the tarball are stored as links, as tar does
+                    inode = (st.st_dev, st.st_ino)
+                    if self.inodes.has_key(inode):
+                        ti.type = tarfile.LNKTYPE
+                        ti.linkname = self.inodes[inode]
+                        ti.size = 0
+                        tar.addfile(ti)
+                        continue
+                    self.inodes[inode] = arcname
+                if tarfile.REGTYPE == ti.type:
+                    with open(path, "rb") as f:
+                        tar.addfile(ti, f)
+                else:
+                    tar.addfile(ti)
+            tar.close()
+        except Exception, e:
+            self.error = e
+            # Drain the queue so the walk is not held up
+            while self.queue.get() is not None:
+                pass
+
+    def Close(self):
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            self.stream.close()
+        except IOError, e:
+            self.error = self.error or e
+        if self.proc and self.proc.wait():
+            self.error = self.error or Exception("Error %s compressing %s" % (self.proc.returncode, self.tarball))
+        self.out.close()
+        if self.error:
+            os.remove(self.tmp)
+            raise Exception("Failed to create %s: %s" % (self.tarball, self.error))
+        # Replace, rather than overwrite, any existing tarball
+        os.rename(self.tmp, self.tarball)
+
+#
+# Create the tarballs of the "entries" of a packaging plan ({tarball, members, dir},
+# relative to "containerDir") in one pass: the union of their members is walked
+# once, with each file and directory routed to the tarballs which include it.
+#
+def CreateArchives(entries, containerDir):
+    format = ExportFormat()
+    writers = []
+    for e in entries:
+        cwd = os.path.join(containerDir, e["dir"])
+        names = ExpandMembers(e["members"], cwd)
+        Log("Creating %s (%s) from %s in %s" % (e["tarball"], format, " ".join(names), cwd))
+        roots = []
+        for n in names:
+            path = os.path.normpath(os.path.join(cwd, n))
+            if not os.path.lexists(path):
+                raise Exception("Cannot create %s: %s does not exist" % (e["tarball"], path))
+            roots.append((path, n.strip("/")))
+        writers.append((os.path.join(containerDir, e["tarball"]), roots))
+    if args.dryrun or not writers:
+        return
+
+    # The members to walk, less any inside another
+    walk = sorted(set([r for w in writers for r, n in w[1]]))
+    walk = [w for w in walk if not [o for o in walk if w.startswith(o + os.sep)]]
+
+    writers = [ArchiveWriter(tarball, roots, format) for tarball, roots in writers]
+    try:
+        for top in walk:
+            st = os.lstat(top)
+            for w in writers:
+                w.Route(top, st)
+            if not stat.S_ISDIR(st.st_mode):
+                continue
+            for dirpath, dirnames, filenames in os.walk(top):
+                dirnames.sort()
+                for n in sorted(dirnames + filenames):
+                    path = os.path.join(dirpath, n)
+                    st = os.lstat(path)
+                    for w in writers:
+                        w.Route(path, st)
+    finally:
+        errors = []
+        for w in writers:
+            try:
+                w.Close()
+            except Exception, e:
+                errors.append(str(e))
+        if errors:
+            raise Exception("; ".join(errors))
+
+#
+# If "cmd" is a simple "tar [-C <dir>] czf <tarball> <paths...>" command return
+# (tarball, paths, dir) so it can be run by CreateArchive, otherwise None and it is
+# left to the shell
+#
+def ParseTarCreate(cmd):
+    parts = cmd.split()
+    if len(parts) < 4 or "tar" != parts[0]:
+        return None
+    parts = parts[1:]
+
+    subdir = ""
+    if "-C" == parts[0]:
+        subdir = parts[1]
+        parts = parts[2:]
+    if len(parts) < 3:
+        return None
+
+    flags = parts[0].lstrip("-")
+    if set(flags) - set("czvf") or -1 == flags.find("c") or -1 == flags.find("z") or not flags.endswith("f"):
+        return None
+    for p in parts[2:]:
+        if p.startswith("-") or [c for c in "|;&<>`$()" if c in p]:
+            return None
+    return parts[1], parts[2:], subdir
+
+#
+# Run "func" on each item of "items" using up to "jobs" threads (in the current
+# session), re-raising the first failure
+#
+def RunParallel(func, items, jobs):
+    if jobs <= 1 or len(items) <= 1:
+        return [func(i) for i in items]
+
+    # The threads work in the caller's session
+    session = CurrentSession()
+    def run(i):
+        with session:
+            return func(i)
+
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        return pool.map(run, items)
+    finally:
+        pool.close()
+
+#
+# Extract the tarballs exported by "deps" into "dest". Tarballs of dependencies
+# which do not depend on each other are extracted at the same time, but a container's
+# tarballs are always extracted after those of the containers it depends on, so any
+# files it has rebuilt replace theirs (as with the serial import). Dependencies
+# extracted at the same time each have their own tree, moved into "dest" in the
+# order of "deps" afterwards, so where they export the same file the last still wins.
+#
+def ImportDeps(dest, deps, hostPrefix, hostPostfix):
+    levels = collections.OrderedDict()
+    for d in deps:
+        level = 0
+        for p in all_containers[d]:
+            if p in levels:
+                level = max(level, levels[p] + 1)
+        levels[d] = level
+
+    def importDep(d, depDest):
+        import_list = container_exports[d]
+        Log("Build: depndendency %s, import list %s" % (d, import_list))
+
+        for g in import_list:
+            fileName = g % (hostPrefix, hostPostfix)
+
+            if -1 == d.find("xcommon"):
+                ExtractArchive(Path("exports", fileName), depDest)
+            else:
+                # Special case for xcommon
+                ExtractArchive(Path("exports", fileName), "%s/Installs/%s/External/Product" % (depDest, CurrentSession().destHost))
+
+    parts = dest + ".parts"
+    for level in sorted(set(levels.values())):
+        levelDeps = [d for d in deps if levels[d] == level]
+        if 1 == len(levelDeps) or args.dryrun:
+            for d in levelDeps:
+                importDep(d, dest)
+            continue
+
+        shutil.rmtree(parts, True)
+        try:
+            RunParallel(lambda d: importDep(d, os.path.join(parts, d)), levelDeps, args.archive_jobs)
+            for d in levelDeps:
+                if os.path.isdir(os.path.join(parts, d)):
+                    MoveTree(os.path.join(parts, d), dest)
+        finally:
+            shutil.rmtree(parts, True)
+
+#
+# Move the files of the tree "src" into "dest", replacing any already there
+#
+def MoveTree(src, dest):
+    for dirpath, dnames, fnames in os.walk(src):
+        destDir = os.path.normpath(os.path.join(dest, os.path.relpath(dirpath, src)))
+        if not os.path.isdir(destDir):
+            os.makedirs(destDir)
+            shutil.copymode(dirpath, destDir)
+        for f in fnames + [d for d in dnames if os.path.islink(os.path.join(dirpath, d))]:
+            os.rename(os.path.join(dirpath, f), os.path.join(destDir, f))
+
+#
+# Copy the tree "src" into "dest" using reflinks, hard links or copies (in that order
+# of preference). Once a method fails it is not tried for the remaining files.
+#
+def CloneTree(src, dest, modes=("reflink", "hardlink", "copy")):
+    modes = list(modes)
+    for dirpath, dnames, fnames in os.walk(src):
+        destDir = os.path.normpath(os.path.join(dest, os.path.relpath(dirpath, src)))
+        if not os.path.isdir(destDir):
+            os.makedirs(destDir)
+        for f in fnames + [d for d in dnames if os.path.islink(os.path.join(dirpath, d))]:
+            used = LinkFile(os.path.join(dirpath, f), os.path.join(destDir, f), modes)
+            if used in modes:
+                modes = modes[modes.index(used):]
+
+#
+# Return the dir of the overlay for "deps": a tree of all the tarballs exported by
+# "deps" already merged together in working/overlays, which is cloned into a
+# container rather than extracting each tarball again. Overlays are keyed by the
+# hashes of the tarballs in them and are created when first needed. Only the latest
+# overlay of each set of deps is kept: creating one removes those it replaces (whose
+# tarballs have since been rebuilt).
+#
+# Each overlay has a manifest of {path : [size, mtime, sha1]}. The files are
+# reflinked or copied into containers, or hard linked with --import-hardlinks (where
+# a build could change them), so the overlay is checked against its manifest before
+# use and re-created if anything has changed.
+#
+overlayManifests = {}
+
+def Overlay(deps, hostPrefix, hostPostfix):
+    h = hashlib.sha1()
+    h.update("host %s\n" % (CurrentSession().destHost,))
+    for d in deps:
+        for g in container_exports[d]:
+            fileName = "exports/" + g % (hostPrefix, hostPostfix)
+            h.update("%s %s %s\n" % (d, fileName, FileHash(Path(fileName))))
+
+    overlayDir = os.path.join(args.overlay_dir, h.hexdigest())
+    manifestFile = overlayDir + "/manifest.json"
+
+    if os.path.exists(manifestFile):
+        manifest = overlayManifests.get(overlayDir)
+        if manifest is None:
+            with open(manifestFile) as f:
+                manifest = json.load(f)
+        tree = StatTree(overlayDir + "/tree")
+        if len(tree) == len(manifest) and not [p for p in manifest if tree.get(p, (0, 0))[:2] != tuple(manifest[p][:2])]:
+            print "Build: using import overlay %s" % (overlayDir,)
+            overlayManifests[overlayDir] = manifest
+            if not os.path.exists(overlayDir + "/info.json"):
+                # Created before overlays recorded their deps
+                with open(overlayDir + "/info.json", "w") as f:
+                    json.dump({"host" : CurrentSession().destHost, "deps" : sorted(deps)}, f)
+            return overlayDir, manifest
+        print "Build: import overlay %s has been modified, re-creating it" % (overlayDir,)
+        overlayManifests.pop(overlayDir, None)
+        shutil.rmtree(overlayDir, True)
+
+    print "Build: creating import overlay %s for %s" % (overlayDir, ", ".join(deps))
+    tmpDir = "%s.%d" % (overlayDir, os.getpid())
+    shutil.rmtree(tmpDir, True)
+    ImportDeps(tmpDir + "/tree", deps, hostPrefix, hostPostfix)
+
+    manifest = {}
+    for path, (size, mtime, ctime) in StatTree(tmpDir + "/tree").items():
+        manifest[path] = [size, mtime, HashFile(tmpDir + "/tree/" + path)]
+    with open(tmpDir + "/manifest.json", "w") as f:
+        json.dump(manifest, f)
+    info = {"host" : CurrentSession().destHost, "deps" : sorted(deps)}
+    with open(tmpDir + "/info.json", "w") as f:
+        json.dump(info, f)
+
+    try:
+        os.rename(tmpDir, overlayDir)
+    except OSError:
+        # Another build has just created the same overlay
+        shutil.rmtree(tmpDir, True)
+    PruneOverlays(overlayDir, info)
+    return overlayDir, manifest
+
+#
+# Remove the overlays of the same deps and host ("info") as "keep", and any created
+# before overlays recorded their deps. Overlays being created (<hash>.<pid>) are left.
+#
+def PruneOverlays(keep, info):
+    for name in os.listdir(args.overlay_dir):
+        overlayDir = os.path.join(args.overlay_dir, name)
+        if overlayDir == keep or "." in name or not os.path.isdir(overlayDir):
+            continue
+        try:
+            with open(overlayDir + "/info.json") as f:
+                other = json.load(f)
+        except (IOError, ValueError):
+            other = None
+        if other is None or other == info:
+            print "Build: removing import overlay %s (replaced by %s)" % (overlayDir, keep)
+            overlayManifests.pop(overlayDir, None)
+            shutil.rmtree(overlayDir, True)
+
+#
+# Merge the imported tree "src", described by "manifest" ({path : [size, mtime, sha1]}),
+# into "container". Only files whose content differs from what is on disk are written,
+# so unchanged files keep their timestamps and incremental builds of the container
+# do not see the whole of the imported SDK as changed. Files recorded in the previous
+# Installs_imports.json are trusted to be unchanged (and not re-hashed) if their size
+# and mtime still match, and are removed if they are no longer imported.
+# Returns the manifest of the imported files as they are now on disk.
+#
+def MergeImports(src, manifest, container, modes=("reflink", "copy")):
+    modes = list(modes)
+    containerDir = Path(container)
+    try:
+        with open(containerDir + "/Installs_imports.json") as f:
+            previous = dict(("Installs/" + p, e) for p, e in json.load(f).items())
+    except (IOError, ValueError):
+        previous = {}
+
+    merged = {}
+    written = 0
+    for path, entry in manifest.items():
+        dest = os.path.join(containerDir, path)
+        try:
+            st = os.lstat(dest)
+        except OSError:
+            st = None
+
+        if st and st.st_size == entry[0]:
+            prev = previous.get(path)
+            if prev and prev[0] == st.st_size and prev[1] == st.st_mtime:
+                sha1 = prev[2]
+            else:
+                sha1 = HashFile(dest)
+            if sha1 == entry[2]:
+                merged[path] = [st.st_size, st.st_mtime, sha1]
+                continue
+
+        destDir = os.path.dirname(dest)
+        if not os.path.isdir(destDir):
+            os.makedirs(destDir)
+        used = LinkFile(os.path.join(src, path), dest, modes)
+        if used in modes:
+            modes = modes[modes.index(used):]
+        st = os.lstat(dest)
+        merged[path] = [st.st_size, st.st_mtime, entry[2]]
+        written += 1
+
+    removed = 0
+    for path, prev in previous.items():
+        if path in merged:
+            continue
+        try:
+            st = os.lstat(os.path.join(containerDir, path))
+        except OSError:
+            continue
+        if prev[0] == st.st_size and prev[1] == st.st_mtime:
+            # Imported last time, not changed by the build and no longer exported
+            os.remove(os.path.join(containerDir, path))
+            removed += 1
+
+    print "Build: imported %d files into %s (%d unchanged, %d removed)" % (written, container, len(merged) - written, removed)
+    return merged
+
+#
+# Record the files imported into Installs (from an import manifest) in Installs_imports.json
+#
+def SaveImportManifest(container, manifest):
+    imports = {}
+    for path, entry in manifest.items():
+        if path.startswith("Installs/"):
+            imports[path[len("Installs/"):]] = entry
+
+    tmpName = "%s/Installs_imports.json.%d" % (Path(container), os.getpid())
+    with open(tmpName, "w") as f:
+        json.dump(imports, f)
+    os.rename(tmpName, Path(container, "Installs_imports.json"))
+    print "Build: %d imported files recorded in %s/Installs_imports.json" % (len(imports), container)
+
+#
+# Jenkinsfile model.
+#
+# Each container's Jenkinsfile is parsed into a model with an entry per host
+# ("Linux" and "PC") holding:
+#   imports - the tarballs copied from other Jenkins jobs: [{projectName, filter, tarballs}]
+#   uploads - the tar commands of the Upload stage, with the tarballs in ../exports
+# The model is cached in <cache-dir>/jenkinsfile, keyed by a hash of the Jenkinsfile.
+#
+JENKINS_MODEL_VERSION = 2
+jenkinsModels = {}
+
+#
+# Return the tarballs the "copyArtifacts" lines in a Jenkinsfile copy, as a dict
+# of lists of {projectName, filter, tarballs} keyed by host
+#
+def ParseImports(lines):
+    imports = {"Linux" : [], "PC" : []}
+
+    for l in lines:
+        if -1 != l.find("copyArtifacts"):
+            parts = l.split()
+
+            if args.debug:
+                print "l:", l, " parts:", parts
+
+            filter = projectName = None
+            for i in range(len(parts) - 1):
+                if parts[i] == "filter:":
+                    filter = parts[i+1].strip("',")
+                if parts[i] == "projectName:":
+                    projectName = parts[i+1].strip("',")
+
+            if not filter or not projectName:
+                continue
+
+            tarballs = []
+            if -1 == filter.find("*"):
+                tarballs.append(filter)
+            else:
+                # Hack - a * at the end of the tarball name implies Installs and private
+                f = filter.replace("*", "Installs")
+                tarballs.append(f)
+                f = filter.replace("*", "private")
+                tarballs.append(f)
+
+            entry = {"projectName" : projectName, "filter" : filter, "tarballs" : tarballs}
+            if -1 != filter.find("Linux64"):
+                imports["Linux"].append(entry)
+            elif -1 != filter.find("Microsoft"):
+                imports["PC"].append(entry)
+
+    return imports
+
+#
+# Return the range of lines (first, last + 1) of the first stage("name") in
+# lines[start:end], up to the brace closing it
+#
+def StageLines(lines, name, start, end):
+    marker = 'stage("%s")' % (name,)
+    for i in range(start, end):
+        if -1 == lines[i].find(marker):
+            continue
+        depth = 0
+        for j in range(i, end):
+            depth += lines[j].count("{") - lines[j].count("}")
+            if depth <= 0 and -1 != lines[j].find("}"):
+                return (i, j + 1)
+        return (i, end)
+    return None
+
+#
+# Return the commands in the Upload stage for "host" which create tarballs, with the
+# tarballs placed in ../exports
+#
+def ParseUploads(lines, host):
+    uploads = []
+
+    if "PC" == host:
+        stage, command, prefix, xcommon = "Windows", "bat ", "Microsoft", "Microsoft_xcommon.zip"
+    else:
+        stage, command, prefix, xcommon = "Centos", "sh ", "Linux64", "Linux64_xcommon.tgz"
+
+    hostLines = StageLines(lines, stage, 0, len(lines))
+    uploadLines = hostLines and StageLines(lines, "Upload", *hostLines)
+    if not uploadLines:
+        return uploads
+
+    for l in lines[uploadLines[0]:uploadLines[1]]:
+        l = l.strip()
+        if 0 != l.find(command) or -1 != l.find(prefix + "_xTIMEdeployer"):
+            # Ignore everything but the commands, and nasties like xflash xTIMEdeployer
+            continue
+
+        if -1 != l.find(prefix + "_xcommon"):
+            # Special case for xcommon due to the root of the tar/zip being down in Installs/%s/External/Product
+            uploads.append('tar -C Installs/%s/External/Product -czf ../exports/%s .' % (host, xcommon))
+            continue
+
+        # Remove Jenkins "bat"/"sh" and the double quotes, and change zip... to tar czf
+        cmd = l[len(command):].strip().strip('"').replace("zip -qr", "tar czf ")
+
+        # Prefix the tarballs with their destination dir
+        cmd = " ".join([("../exports/" + part if -1 != part.find(".tgz") else part) for part in cmd.split()])
+
+        if 0 == cmd.find("tar"):
+            uploads.append(cmd)
+
+    return uploads
+
+#
+# Return the model of the Jenkinsfile of a container
+#
+def JenkinsModel(container):
+    with open(Path(container, "Jenkinsfile")) as f:
+        text = f.read()
+    key = hashlib.sha1("%d\n%s" % (JENKINS_MODEL_VERSION, text)).hexdigest()
+
+    model = jenkinsModels.get(key)
+    if model:
+        return model
+
+    cacheFile = os.path.join(args.cache_dir, "jenkinsfile", key + ".json")
+    try:
+        with open(cacheFile) as f:
+            model = json.load(f)
+    except (IOError, ValueError):
+        lines = text.splitlines(True)
+        imports = ParseImports(lines)
+        model = {"hosts" : {}}
+        for host in ("Linux", "PC"):
+            model["hosts"][host] = {"imports" : imports[host], "uploads" : ParseUploads(lines, host)}
+
+        if not os.path.isdir(os.path.dirname(cacheFile)):
+            os.makedirs(os.path.dirname(cacheFile))
+        tmp = "%s.%d" % (cacheFile, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(model, f, indent=1)
+        os.rename(tmp, cacheFile)
+
+    jenkinsModels[key] = model
+    return model
+
+#
+# Return the plan for creating the export tarballs of a container for "host" from
+# its Jenkinsfile model. Each entry is either
+#   {tarball, members, dir} - create "tarball" from "members" (relative to "dir"), or
+#   {shell}                 - a command which must be run by the shell
+#
+def PackagingPlan(model, host, debugbuild):
+    plan = []
+    for cmd in model["hosts"][host]["uploads"]:
+        if debugbuild:
+            # for xc_compiler_combined:tools_xcc1_c_llvm
+            if "PC" == host:
+                cmd = cmd.replace("\\Release\\", "\\Debug\\")
+            else:
+                cmd = cmd.replace("/Release/", "/Debug/")
+
+        parsed = ParseTarCreate(cmd)
+        if parsed:
+            tarball, members, subdir = parsed
+            plan.append({"tarball" : tarball, "members" : members, "dir" : subdir})
+        else:
+            plan.append({"shell" : cmd})
+    return plan
+
+
+#
+# Import the exports of "deps" into a container: the overlay of them (or the
+# tarballs extracted into Installs_imports) is merged into the container
+#
+def ImportContainer(container, deps, hostPrefix, hostPostfix):
+    if deps and not args.no_overlay and not args.dryrun:
+        # Clone the pre-merged tarballs of the dependencies into the container. Builds
+        # write Installs in place, so the overlay's files are only hard linked (shared
+        # with every other container using it) with --import-hardlinks
+        overlayDir, manifest = Overlay(deps, hostPrefix, hostPostfix)
+        modes = ("reflink", "copy")
+        if args.import_hardlinks:
+            modes = ("reflink", "hardlink", "copy")
+        SaveImportManifest(container, MergeImports(overlayDir + "/tree", manifest, container, modes))
+    else:
+        # Iterate of the locally built dependency container and unpack the their tarballs
+        # into Installs_imports, then merge the files which have changed into the container
+        staging = Path(container, "Installs_imports")
+        shutil.rmtree(staging, True)
+        ImportDeps(staging, deps, hostPrefix, hostPostfix)
+        if args.dryrun:
+            # Nothing was extracted, so there is nothing to merge (or remove)
+            return
+
+        manifest = {}
+        for path, (size, mtime, ctime) in StatTree(staging).items():
+            manifest[path] = [size, mtime, HashFile(staging + "/" + path)]
+        # The staging tree is removed, so its files can be linked into the container
+        SaveImportManifest(container, MergeImports(staging, manifest, container, ("hardlink", "copy")))
+        shutil.rmtree(staging, True)
+
+#
+# Create the export tarballs of a container in working/exports from the files its
+# build has produced in Installs, using the Upload commands of its Jenkinsfile
+#
+def ExportContainer(container, debugbuild, hostPrefix, hostPostfix):
+    ## Create the tarballs for installation - from the Upload sh commands
+    plan = PackagingPlan(JenkinsModel(container), CurrentSession().destHost, debugbuild)
+    containerDir = Path(container)
+    installs = os.path.join(containerDir, "Installs")
+    if args.dryrun:
+        for e in plan:
+            if "shell" in e:
+                Cmd(e["shell"], True, cwd=containerDir)
+            else:
+                Log("Creating %s from %s in %s" % (e["tarball"], " ".join(e["members"]), os.path.join(containerDir, e["dir"])))
+        return
+
+    working = os.path.join(containerDir, "Installs_working")
+    if os.path.isdir(working):
+        # A previous export was killed while Installs held the files to export
+        print "Build: restoring %s/Installs after an interrupted export" % (container,)
+        shutil.rmtree(installs, True)
+        os.rename(working, installs)
+    shutil.rmtree(os.path.join(containerDir, "Installs_exports"), True)
+
+    # Find only the files this container build has produced in Installs
+    if os.path.isdir(installs):
+        with Phase("export", container):
+            ExportInstalls(containerDir)
+
+    # Installs holds just the files to export while the tarballs are created
+    os.rename(installs, working)
+    os.rename(os.path.join(containerDir, "Installs_exports"), installs)
+    try:
+        # Remove the previous exports rather than overwriting them as they may be
+        # hard linked into the build cache
+        if container in container_exports:
+            for g in container_exports[container]:
+                fileName = Path("exports", g % (hostPrefix, hostPostfix))
+                if os.path.exists(fileName):
+                    os.remove(fileName)
+
+        # Create the tarballs of the simple tar commands in one pass over Installs, while
+        # any other commands are run by the shell
+        tarballs = [e for e in plan if "shell" not in e]
+        def upload(entry):
+            if entry is tarballs:
+                CreateArchives(tarballs, containerDir)
+            else:
+                Cmd(entry["shell"], True, cwd=containerDir)
+
+        with Phase("package", container):
+            RunParallel(upload, [tarballs] + [e for e in plan if "shell" in e], args.archive_jobs)
+    finally:
+        os.rename(installs, os.path.join(containerDir, "Installs_exports"))
+        os.rename(working, installs)
+
+def Build(container, domains, deps, debugbuild, reimport):
+    print "Build(container %s, deps %s, debugbuild %s, reimport %s)" % (container, deps, debugbuild, reimport)
+
+    hostPrefix, hostPostfix = HostTarballs()
+
+    userDomains = domains
+    if "" == domains:
+        # No domains specified by the user
+
+        if build_domains.has_key(container):
+            domains = build_domains[container]
+        else:
+            # Find the list of domains to build - any subdir with a Build.pl file is selected
+            glist = [os.path.relpath(g, Path(container)) for g in glob.glob(Path(container, "*", "Build.pl"))]
+
+            print "glist: ", glist
+
+            for g in sorted(glist):
+                d = os.path.dirname(g)
+                if d in ignoreDomains:
+                    continue
+                domains += d + ","
+
+    if debugbuild:
+       config = "Debug"
+    else:
+       config = "Release"
+
+    sourceState = None
+    if not reimport and not args.dryrun and os.path.exists(RepoDir(container) + "/.git"):
+        sourceState = SourceState(container)
+
+    # If this exact build has been done before just restore its exports
+    cacheKey = None
+    if not reimport and not args.no_cache and not args.dryrun and container in container_exports:
+        with Phase("cache", container):
+            cacheKey = CacheKey(container, domains, deps, config, hostPrefix, hostPostfix)
+            if RestoreFromCache(container, cacheKey, hostPrefix, hostPostfix):
+                if sourceState:
+                    SaveSourceState(container, sourceState)
+                return
+
+    # Remove any temporary import/export dirs
+    for i in ("Installs_imports", "Installs_exports"):
+        try:
+            shutil.rmtree(Path(container, i), True)
+        except WindowsError, e:
+            print "Failed shutil.rmtree(%s/%s) : %s" % (container, i, e)
+            pass
+
+    with Phase("import", container):
+        ImportContainer(container, deps, hostPrefix, hostPostfix)
+
+    # The above steps have pulled in the stuff built and exported by parent containers
+    if reimport:
+        return
+
+    # Only build the domains which have changed, if the user has not chosen them
+    domainStates = None
+    if args.incremental and not userDomains and not args.dryrun:
+        selected, domainStates = IncrementalDomains(container, [d for d in domains.split(",") if d], config,
+                                                    ImportsHash(container, deps, hostPrefix, hostPostfix))
+        domains = ",".join(selected)
+
+    #    cmd = "bash -c 'cd %s/infr_scripts_pl/Build && ls -l SetupEnv && source ./SetupEnv && cd ../.. && Build.pl DOMAINS=%s CONFIG=%s'" % (container, domains, config)
+    ## DEBUG Build
+    ##    cmd = "bash -c 'cd %s/infr_scripts_pl/Build && ls -l SetupEnv && source ./SetupEnv && cd ../.. && Build.pl DOMAINS=%s CONFIG=Debug'" % (container, domains)
+    ## RELEASE Build
+
+    # TODO FAILS "source ./SetupEnv" on msys2
+    #    cmd = "bash -c 'which bash && cd %s/infr_scripts_pl/Build && ls -l && ls -l SetupEnv && source ./SetupEnv && cd ../.. && Build.pl DOMAINS=%s CONFIG=Release'" % (container, domains)
+
+    # The build script is per container so that several containers can be built at once.
+    # It is run in the working area.
+    if "Linux" == CurrentSession().buildHost:
+        script = "build_%s.sh" % (container,)
+        with open(Path(script), "w") as f:
+            f.write("#!/usr/bin/bash\n")
+            f.write("cd %s/infr_scripts_pl/Build\n" % (container,))
+            f.write("source ./SetupEnv\n")
+            if os.environ.get('MSYSTEM'):
+                f.write("export PATH=$PATH:/apache-ant-1.10.12/bin")
+                f.write("export JAVA_HOME=/jdk-18.0.2.1")
+            if Jobserver():
+                f.write("export MAKEFLAGS=\"%s\"\n" % (JobserverMakeflags(),))
+            f.write("cd ../..\n")
+            f.write("Build.pl DOMAINS=%s CONFIG=%s\n" % (domains, config))
+
+        cmd = "bash %s" % (script,)
+    else:
+        script = "build_%s.bat" % (container,)
+        with open(Path(script), "w") as f:
+            f.write("cd %s/infr_scripts_pl/Build\n" % (container,))
+            f.write("call SetupEnv.bat\n")
+#            f.write("set PATH=%PATH%;c:\\msys64\\usr\\bin\n")    # For BISON
+            f.write("set PATH=%PATH%;c:\\strawberry\\perl\\bin\n")
+            f.write("set PATH=%PATH%;c:\\msys64\\apache-ant-1.10.12\\bin\n")
+            f.write("set JAVA_HOME=C:\\Program Files\\Eclipse Adoptium\\jdk-17.0.4.101-hotspot\n")
+            f.write("perl Build.pl DOMAINS=%s CONFIG=%s\n" % (domains, config))
+        cmd = "cmd /c %s" % (script,)
+    print "cmd: ", cmd
+    if "" == domains:
+        print "Build: no domains of %s have changed, not running Build.pl" % (container,)
+    else:
+        with Phase("Build.pl", container, domains):
+            Cmd(cmd, True, cwd=Path())
+
+    ExportContainer(container, debugbuild, hostPrefix, hostPostfix)
+
+    if cacheKey:
+        with Phase("cache", container):
+            SaveToCache(container, cacheKey, hostPrefix, hostPostfix)
+
+    if container in container_exports:
+        RecordArtifacts(container, [Path("exports", g % (hostPrefix, hostPostfix)) for g in container_exports[container]])
+
+    if domainStates:
+        SaveDomainStates(container, config, domainStates)
+    if sourceState:
+        SaveSourceState(container, sourceState)
+
+
+#
+# Git clones.
+#
+# Every repo cloned (container, submodule or helper repo) borrows its objects from a
+# mirror of the repo in the git cache (--git-cache, shared by all working areas),
+# so only the mirror is fetched from the server - once per clone - and the clones
+# themselves are local and take little disk. Submodule mirrors are fetched at the
+# same time.
+#
+# The clones use git alternates so the mirrors must not be deleted. Automatic gc is
+# disabled when fetching so objects the clones use are not pruned.
+#
+mirrorLock = threading.Lock()
+mirrorLocks = {}
+
+def Mirror(url):
+    path = os.path.join(os.path.expanduser(args.git_cache), re.sub(r"[^A-Za-z0-9._-]+", "_", url) + ".git")
+
+    with mirrorLock:
+        lock = mirrorLocks.setdefault(path, threading.Lock())
+
+    mirrorsFetched = CurrentSession().mirrorsFetched
+    with lock:
+        if path in mirrorsFetched:
+            return path
+        if os.path.isdir(path):
+            Cmd(["git", "-c", "gc.auto=0", "--git-dir", path, "fetch", "--prune", "--quiet"])
+        else:
+            tmp = "%s.%d" % (path, os.getpid())
+            shutil.rmtree(tmp, True)
+            Cmd(["git", "clone", "--mirror", "--quiet", url, tmp])
+            if not args.dryrun:
+                os.rename(tmp, path)
+        mirrorsFetched.add(path)
+    return path
+
+#
+# Resolve a relative submodule url ("../repo") against the url of its superproject
+#
+def ResolveUrl(base, url):
+    if not url.startswith("./") and not url.startswith("../"):
+        return url
+    sep = "/"
+    base = base.rstrip("/")
+    while url.startswith("./") or url.startswith("../"):
+        if url.startswith("./"):
+            url = url[2:]
+            continue
+        url = url[3:]
+        i = max(base.rfind("/"), base.rfind(":"))
+        sep = base[i]
+        base = base[:i]
+    return base + sep + url
+
+#
+# Initialise and update the submodules of the repo in "repoDir" (recursively), using the git cache
+#
+def UpdateSubmodules(repoDir):
+    if args.dryrun or not os.path.exists(os.path.join(repoDir, ".gitmodules")):
+        return
+
+    try:
+        config = CmdOutput(["git", "config", "-f", ".gitmodules", "--get-regexp", r"^submodule\..*\.(path|url)$"], repoDir)
+    except subprocess.CalledProcessError:
+        return
+    origin = CmdOutput(["git", "config", "remote.origin.url"], repoDir).strip()
+
+    submodules = collections.OrderedDict()
+    for l in config.splitlines():
+        key, value = l.split(" ", 1)
+        name, field = key[len("submodule."):].rsplit(".", 1)
+        submodules.setdefault(name, {})[field] = value
+
+    modules = [(m["path"], ResolveUrl(origin, m["url"])) for m in submodules.values() if "path" in m and "url" in m]
+    mirrors = RunParallel(lambda m: Mirror(m[1]), modules, args.clone_jobs)
+
+    # Updating writes the superproject config, so is done one submodule at a time
+    Cmd("git submodule init", cwd=repoDir)
+    for (path, url), mirror in zip(modules, mirrors):
+        Cmd(["git", "submodule", "update", "--reference", mirror, "--", path], cwd=repoDir)
+
+    RunParallel(lambda m: UpdateSubmodules(os.path.join(repoDir, m[0])), modules, args.clone_jobs)
+
+#
+# Clone "url" (and its submodules) into "dest" (relative to "cwd", by default the working area)
+#
+def CloneRepo(url, dest, cwd=None):
+    cwd = cwd or Path()
+    if args.no_git_cache:
+        Cmd(["git", "clone", "--recurse-submodules", "--jobs", str(args.clone_jobs), url, dest], cwd=cwd)
+        return
+
+    Cmd(["git", "clone", "--reference", Mirror(url), url, dest], cwd=cwd)
+    UpdateSubmodules(os.path.join(cwd, dest))
+
+#
+# Clone the repos needed in every container which are not part of it
+#
+def CloneHelpers(container):
+    if not os.path.exists(Path(container, "infr_scripts_pl")):
+        CloneRepo("git@github.com:xmos/infr_scripts_pl", "infr_scripts_pl", Path(container))
+
+    # Hack for xmap
+    if not os.path.exists(Path(container, "tools_bin2header")):
+        CloneRepo("git@github.com:xmos/bin2header", "tools_bin2header", Path(container))
+
+#
+# Clone a container repo (and its submodules) into the working area
+#
+def Clone(container):
+    flat = False
+    tools_dir = container
+    cwd = None
+
+    c_info = container_mapping_info.get(container)
+    if c_info:
+        domain = c_info.get("domain")
+        if domain:
+            tools_dir = domain
+
+        flat = c_info.get("flat_structure")
+
+        if flat:
+           os.mkdir(Path(container))
+           cwd = Path(container)
+
+    CloneRepo("git@github0.xmos.com:xmos-int/%s" % (container,), tools_dir, cwd)
+
+    if flat:
+       # Create for the Build fn which needs to extract the "upload entries"
+       if platform.platform().find("Windows") != -1:
+           shutil.copy(Path(container, tools_dir, "Jenkinsfile"), Path(container, "Jenkinsfile"))
+       else:
+           os.symlink(tools_dir + "/Jenkinsfile", Path(container, "Jenkinsfile"))
+
+#
+# Working areas cloned from another (--from).
+#
+# Each repo (container, submodules and helper repos) is cloned with
+# "git clone --shared", so it borrows the objects of the existing area's repo
+# rather than copying them (which must therefore be kept), and checked out at
+# the same commit with its origin set to the same server. The unpacked Installs,
+# downloaded tarballs, exports, build cache and overlays are reflinked (copy on
+# write) or hard linked. Installs is written in place by builds, so it is only
+# hard linked with --snapshot-hardlinks, otherwise copied if reflinks are not
+# supported. Uncommitted changes in the existing area are not copied.
+#
+def CloneRepoFrom(src, dest):
+    if os.path.isdir(dest) and os.listdir(dest):
+        raise Exception("Cannot clone %s into %s: it is not empty" % (src, dest))
+    Cmd(["git", "clone", "-q", "--shared", "--no-checkout", os.path.abspath(src), dest])
+
+    head = CmdOutput(["git", "rev-parse", "HEAD"], src).strip()
+    Cmd(["git", "checkout", "-q", "--detach", head], cwd=dest)
+    try:
+        branch = CmdOutput(["git", "symbolic-ref", "-q", "--short", "HEAD"], src).strip()
+    except subprocess.CalledProcessError:
+        branch = None
+    if branch:
+        Cmd(["git", "checkout", "-q", "-B", branch], cwd=dest)
+
+    try:
+        url = CmdOutput(["git", "config", "remote.origin.url"], src).strip()
+        Cmd(["git", "remote", "set-url", "origin", url], cwd=dest)
+    except subprocess.CalledProcessError:
+        pass
+
+    # The submodules, which are listed before those within them
+    if os.path.exists(os.path.join(src, ".gitmodules")):
+        Cmd(["git", "submodule", "--quiet", "init"], cwd=dest)
+        for line in CmdOutput(["git", "submodule", "status"], src).splitlines():
+            if line.startswith("-"):
+                continue
+            path = line[1:].split()[1]
+            CloneRepoFrom(os.path.join(src, path), os.path.join(dest, path))
+
+def CloneContainerFrom(fromWorking, container):
+    src = os.path.join(fromWorking, container)
+    containerDir = Path(container)
+    srcRepo = src
+    c_info = container_mapping_info.get(container)
+    if not os.path.exists(os.path.join(src, ".git")) and c_info and c_info.get("flat_structure"):
+        srcRepo = os.path.join(src, c_info["domain"])
+    Log("Cloning %s from %s" % (container, src))
+    if args.dryrun:
+        return
+
+    if not os.path.isdir(containerDir):
+        os.mkdir(containerDir)
+    if srcRepo != src:
+        # Flat structure, the repo is in a subdir named after the domain
+        CloneRepoFrom(srcRepo, os.path.join(containerDir, os.path.basename(srcRepo)))
+    else:
+        CloneRepoFrom(src, containerDir)
+
+    installsModes = ("reflink", "copy")
+    if args.snapshot_hardlinks:
+        installsModes = ("reflink", "hardlink", "copy")
+
+    for name in sorted(os.listdir(src)):
+        path = os.path.join(src, name)
+        dest = os.path.join(containerDir, name)
+        if os.path.lexists(dest):
+            continue
+        if name in ("infr_scripts_pl", "tools_bin2header"):
+            if os.path.exists(os.path.join(path, ".git")):
+                CloneRepoFrom(path, dest)
+            else:
+                CloneTree(path, dest, ("reflink", "copy"))
+        elif "Installs" == name:
+            CloneTree(path, dest, installsModes)
+        elif os.path.islink(path):
+            os.symlink(os.readlink(path), dest)
+        elif os.path.isfile(path) and (fnmatch.fnmatch(name, "*.tgz") or fnmatch.fnmatch(name, "*.tar.gz") or fnmatch.fnmatch(name, "*.meta") or
+                                       name.startswith(".build_tools") or "Installs_imports.json" == name):
+            # Downloaded tarballs (replaced rather than overwritten when updated) and build records
+            LinkFile(path, dest, ("reflink", "hardlink", "copy"))
+
+def CloneFrom(fromArea, containers):
+    fromWorking = os.path.abspath(fromArea)
+    if os.path.isdir(os.path.join(fromWorking, "working")):
+        fromWorking = os.path.join(fromWorking, "working")
+    if not os.path.isdir(fromWorking):
+        raise Exception("--from %s: no working area found" % (fromArea,))
+    if Path() == fromWorking:
+        raise Exception("--from %s: this is the working area being created" % (fromArea,))
+
+    containers = [c for c in containers if os.path.isdir(os.path.join(fromWorking, c))]
+    with Phase("clone"):
+        RunParallel(lambda c: CloneContainerFrom(fromWorking, c), containers, args.clone_jobs)
+
+    for d in (Path("exports"), args.cache_dir, args.overlay_dir):
+        d = os.path.relpath(d, Path())
+        if os.path.isdir(os.path.join(fromWorking, d)):
+            Log("Linking %s from %s" % (d, fromWorking))
+            if not args.dryrun:
+                with Phase("snapshot", detail=d):
+                    CloneTree(os.path.join(fromWorking, d), Path(d), ("reflink", "hardlink", "copy"))
+
+#
+# Return the Linux64 tarballs the Jenkinsfile of a container copies from other
+# Jenkins jobs as a list of (tarball, url)
+#
+def Artifacts(container):
+    base = args.jenkins_url + "%s/lastSuccessfulBuild/artifact/%s"
+    artifacts = []
+
+    for entry in JenkinsModel(container)["hosts"]["Linux"]["imports"]:
+        for t in entry["tarballs"]:
+            project_parts = entry["projectName"].split("/")
+
+            subpath = ""
+            for p in project_parts:
+                subpath += "/job/%s" % (p,)
+
+            artifacts.append((t, base % (subpath, t)))
+
+    return artifacts
+
+#
+# HTTP downloads.
+#
+# Each download thread keeps a connection open to each server. A tarball is
+# downloaded to <tarball>.part and renamed when complete, so the previous one is
+# kept until then. The ETag/Last-Modified of each tarball are kept in <tarball>.meta
+# and sent with the next request so unchanged tarballs are not downloaded again,
+# and an interrupted download is resumed with a Range request.
+#
+downloadConnections = threading.local()
+
+def HttpRequest(url, headers):
+    for redirect in range(5):
+        parsed = urlparse.urlsplit(url)
+        if not hasattr(downloadConnections, "pool"):
+            downloadConnections.pool = {}
+        key = (parsed.scheme, parsed.netloc)
+        conn = downloadConnections.pool.get(key)
+        if not conn:
+            if "https" == parsed.scheme:
+                conn = httplib.HTTPSConnection(parsed.netloc, timeout=60)
+            else:
+                conn = httplib.HTTPConnection(parsed.netloc, timeout=60)
+            downloadConnections.pool[key] = conn
+
+        path = parsed.path
+        if parsed.query:
+            path += "?" + parsed.query
+        try:
+            conn.request("GET", path, headers=headers)
+            resp = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            # The server may have closed the kept-alive connection - retry on a new one
+            conn.close()
+            conn.request("GET", path, headers=headers)
+            resp = conn.getresponse()
+
+        if resp.status in (301, 302, 303, 307, 308):
+            resp.read()
+            url = urlparse.urljoin(url, resp.getheader("location"))
+            continue
+        return resp
+
+    raise Exception("Too many redirects downloading %s" % (url,))
+
+#
+# Download "url" to "dest" unless it is unchanged since the last download.
+# Returns True if "dest" has changed.
+#
+def Download(url, dest):
+    metaFile = dest + ".meta"
+    partFile = dest + ".part"
+
+    try:
+        with open(metaFile) as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        meta = {}
+
+    headers = {}
+    if os.path.exists(dest) and meta.get("url") == url and meta.get("size") == os.path.getsize(dest):
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    # Resume a partial download if it is of the same version of the file
+    offset = 0
+    partMeta = meta.get("part", {})
+    if os.path.exists(partFile) and partMeta.get("url") == url and (partMeta.get("etag") or partMeta.get("last_modified")):
+        offset = os.path.getsize(partFile)
+        headers["Range"] = "bytes=%d-" % (offset,)
+        headers["If-Range"] = partMeta.get("etag") or partMeta.get("last_modified")
+
+    resp = HttpRequest(url, headers)
+
+    if 304 == resp.status:
+        resp.read()
+        Log("Download: %s is unchanged" % (dest,))
+        return False
+
+    if 206 == resp.status:
+        # Content-Range: bytes <start>-<end>/<size>
+        size = int(resp.getheader("content-range").split("/")[1])
+        mode = "ab"
+        Log("Download: resuming %s at %d of %d bytes" % (url, offset, size))
+    elif 200 == resp.status:
+        size = resp.getheader("content-length")
+        if size is not None:
+            size = int(size)
+        mode = "wb"
+        offset = 0
+        Log("Download: %s" % (url,))
+    else:
+        resp.read()
+        raise Exception("Error %s %s, failed to download %s" % (resp.status, resp.reason, url))
+
+    meta["part"] = {"url" : url, "etag" : resp.getheader("etag"), "last_modified" : resp.getheader("last-modified")}
+    with open(metaFile, "w") as f:
+        json.dump(meta, f)
+
+    with open(partFile, mode) as f:
+        for chunk in iter(lambda: resp.read(1024 * 1024), ""):
+            f.write(chunk)
+
+    got = os.path.getsize(partFile)
+    if size is not None and got != size:
+        raise Exception("Download of %s incomplete: %d of %d bytes" % (url, got, size))
+
+    os.rename(partFile, dest)
+    meta = {"url" : url, "etag" : resp.getheader("etag"), "last_modified" : resp.getheader("last-modified"), "size" : got}
+    with open(metaFile, "w") as f:
+        json.dump(meta, f)
+    return True
+
+#
+# Local artifact store.
+#
+# Downloaded tarballs (and those built locally) are kept in a store shared by all
+# working areas, --artifact-store, by the sha256 of their contents:
+#   blobs/<aa>/<sha256>       the tarball, hard linked into the containers using it
+#   blobs/<aa>/<sha256>.json  {tarball, url, job, build, size, time} - its mtime is
+#                             the time the blob was last used
+#   urls/<sha1 of url>        the latest download of a url (a link to its blob), with
+#                             the .meta/.part of Download(), and a .json history of
+#                             the builds downloaded [{hash, build, time}]
+# So a tarball imported by several containers (or working areas) is downloaded and
+# stored once, and an earlier build can be used again (--artifact-build) without
+# downloading it. The store is kept under --artifact-store-size GB by removing the
+# least recently used blobs which are not linked anywhere else.
+#
+storeLock = threading.Lock()
+jenkinsBuilds = {}
+
+def BlobPath(h):
+    return os.path.join(args.artifact_store, "blobs", h[:2], h)
+
+def ReadJson(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
 
-containers_todo = []
+def WriteJson(path, data):
+    tmp = "%s.%d.%d" % (path, os.getpid(), threading.current_thread().ident)
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=1)
+    os.rename(tmp, path)
+
+#
+# The number of the Jenkins build "url" (a lastSuccessfulBuild artifact) is from
+#
+def JenkinsBuild(url):
+    m = re.search(r"/(\d+)/artifact/", url)
+    if m:
+        return int(m.group(1))
+    if -1 == url.find("/lastSuccessfulBuild/"):
+        return None
+    job = url.split("/lastSuccessfulBuild/")[0]
+    if not jenkinsBuilds.has_key(job):
+        number = None
+        try:
+            resp = HttpRequest(job + "/lastSuccessfulBuild/buildNumber", {})
+            body = resp.read()
+            if 200 == resp.status and body.strip().isdigit():
+                number = int(body.strip())
+        except (httplib.HTTPException, socket.error):
+            pass
+        jenkinsBuilds[job] = number
+    return jenkinsBuilds[job]
 
-for c in all_containers:
-    if 0 == len(args.containers):
-        containers_todo.append(c)
+#
+# Add the file "path" to the store (linking it, or copying if the store is on
+# another filesystem) with metadata "info", returning its hash
+#
+def StoreInsert(path, info, h=None):
+    h = h or Sha256File(path)
+    blob = BlobPath(h)
+    if not os.path.exists(blob):
+        if not os.path.isdir(os.path.dirname(blob)):
+            try:
+                os.makedirs(os.path.dirname(blob))
+            except OSError:
+                pass
+        tmp = "%s.tmp%d.%d" % (blob, os.getpid(), threading.current_thread().ident)
+        LinkFile(path, tmp)
+        os.rename(tmp, blob)
+
+    metaFile = blob + ".json"
+    meta = ReadJson(metaFile, {})
+    if not meta:
+        meta = dict(info)
+        meta.update({"hash" : h, "size" : os.path.getsize(blob), "time" : time.time()})
+        WriteJson(metaFile, meta)
     else:
-        for arg in args.containers: 
-            repo = arg.split(":")[0]
-            if c == repo:
-                containers_todo.append(arg)
+        # Mark as recently used
+        os.utime(metaFile, None)
+    return h
+
+#
+# Bring the store's copy of "url" up to date, returning its hash. With "build" the
+# blob of that build is used if it is in the store, otherwise it is downloaded.
+#
+def StoreFetch(url, build=None):
+    key = os.path.join(args.artifact_store, "urls", hashlib.sha1(url).hexdigest())
+    history = ReadJson(key + ".json", [])
+
+    if build is not None:
+        for entry in reversed(history):
+            if build == entry.get("build") and os.path.exists(BlobPath(entry["hash"])):
+                Log("Download: using build %d of %s from the artifact store" % (build, url))
+                os.utime(BlobPath(entry["hash"]) + ".json", None)
+                return entry["hash"]
+        buildUrl = url.replace("/lastSuccessfulBuild/", "/%d/" % (build,))
+        h = StoreFetch(buildUrl)
+        history.append({"hash" : h, "build" : build, "time" : time.time()})
+        WriteJson(key + ".json", history)
+        return h
+
+    Download(url, key)
+
+    # The hash is known unless a new version has been downloaded
+    st = os.stat(key)
+    stamp = [st.st_ino, st.st_size, st.st_mtime]
+    if history and history[-1].get("stamp") == stamp and os.path.exists(BlobPath(history[-1]["hash"])):
+        os.utime(BlobPath(history[-1]["hash"]) + ".json", None)
+        return history[-1]["hash"]
+
+    build = JenkinsBuild(url)
+    job = re.sub(r"/(lastSuccessfulBuild|\d+)/artifact/.*$", "", url)
+    h = StoreInsert(key, {"url" : url, "tarball" : url.split("/")[-1], "job" : job, "build" : build})
+    Log("Download: stored %s (build %s) as %s" % (url, build, h))
+    history.append({"hash" : h, "build" : build, "time" : time.time(), "stamp" : stamp})
+    WriteJson(key + ".json", history)
+    return h
+
+#
+# Link the blob "h" to "dest" (in a container), returning True if "dest" has changed
+#
+def StoreLink(h, dest, url):
+    blob = BlobPath(h)
+    metaFile = dest + ".meta"
+    meta = {"url" : url, "hash" : h, "build" : PinnedBuild(url) or ReadJson(blob + ".json", {}).get("build")}
+    previous = ReadJson(metaFile, {})
+    changed = not os.path.exists(dest) or previous.get("hash") != h or os.path.getsize(dest) != os.path.getsize(blob)
+    if changed:
+        LinkFile(blob, dest)
+    if changed or previous != meta:
+        WriteJson(metaFile, meta)
+    return changed
+
+#
+# Remove the least recently used blobs, which are not linked elsewhere, until the
+# store is under --artifact-store-size GB
+#
+def EvictArtifacts():
+    maxBytes = int(args.artifact_store_size * 1024 * 1024 * 1024)
+    blobs = []
+    total = 0
+    for metaFile in glob.glob(os.path.join(args.artifact_store, "blobs", "*", "*.json")):
+        blob = metaFile[:-len(".json")]
+        try:
+            st = os.stat(blob)
+        except OSError:
+            continue
+        total += st.st_size
+        if 1 == st.st_nlink:
+            blobs.append((os.path.getmtime(metaFile), blob, st.st_size))
+
+    for used, blob, size in sorted(blobs):
+        if total <= maxBytes:
+            break
+        Log("Artifact store: evicting %s (%d bytes)" % (os.path.basename(blob), size))
+        os.remove(blob)
+        os.remove(blob + ".json")
+        total -= size
+
+#
+# The --artifact-build pinned for the job of "url", or None
+#
+def PinnedBuild(url):
+    for pin in args.artifact_build or []:
+        job, number = pin.rsplit("=", 1)
+        if -1 != url.find("/job/%s/" % (job,)) or -1 != url.find("/job/%s/" % ("/job/".join(job.split("/")),)):
+            return int(number)
+    return None
+
+#
+# Download all of "downloads", a list of (url, dest), at once.
+# Returns the list of the dests which have changed.
+#
+def DownloadAll(downloads):
+    if args.dryrun:
+        for url, dest in downloads:
+            Log("Download: %s to %s" % (url, dest))
+        return []
+
+    if not args.no_artifact_store:
+        return StoreDownloadAll(downloads)
+
+    errors = []
+    def download(item):
+        try:
+            with Phase("download-file", detail=item[0]):
+                return Download(*item)
+        except Exception, e:
+            errors.append("%s: %s" % (item[0], e))
+            return False
+
+    changed = RunParallel(download, downloads, args.download_jobs)
+    if errors:
+        raise Exception("Failed downloads:\n  " + "\n  ".join(errors))
+    return [dest for (url, dest), c in zip(downloads, changed) if c]
+
+#
+# DownloadAll() through the artifact store: each url is fetched into the store
+# once, then linked into each container needing it
+#
+def StoreDownloadAll(downloads):
+    for d in ("blobs", "urls"):
+        if not os.path.isdir(os.path.join(args.artifact_store, d)):
+            os.makedirs(os.path.join(args.artifact_store, d))
+
+    urls = list(collections.OrderedDict([(url, None) for url, dest in downloads]))
+    errors = []
+    def fetch(url):
+        try:
+            with Phase("download-file", detail=url):
+                return StoreFetch(url, PinnedBuild(url))
+        except Exception, e:
+            errors.append("%s: %s" % (url, e))
+            return None
+
+    hashes = dict(zip(urls, RunParallel(fetch, urls, args.download_jobs)))
+    if errors:
+        raise Exception("Failed downloads:\n  " + "\n  ".join(errors))
+
+    changed = [dest for url, dest in downloads if StoreLink(hashes[url], dest, url)]
+    with storeLock:
+        EvictArtifacts()
+    return changed
+
+#
+# Populate the given containers with the latest tarballs built by Jenkins for the
+# containers they depend on, cloning the container repos first (at the same time)
+# unless updateOnly.
+# The tarballs for all the containers are downloaded at the same time. Tarballs are
+# only extracted again if they have changed since the last update.
+#
+def Unpack(containers, updateOnly):
+    events = CurrentSession().timingEvents
+    first = len(events)
+    if not updateOnly:
+        # Do a full clone
+        with Phase("clone"):
+            RunParallel(Clone, containers, args.clone_jobs)
+
+    artifacts = collections.OrderedDict()
+    downloads = []
+    for container in containers:
+        artifacts[container] = Artifacts(container)
+        downloads += [(url, Path(container, t)) for t, url in artifacts[container]]
+
+    with Phase("download"):
+        changed = DownloadAll(downloads)
+
+    for container in containers:
+        for t, url in artifacts[container]:
+            path = Path(container, t)
+            if updateOnly and path not in changed:
+                continue
 
-if 0 == len(containers_todo):
-    print("Invalid container(s) specified")
-    sys.exit(1)
+            with Phase("extract", container, t):
+                if "Linux64_xcommon.tgz" == t:
+                    ExtractArchive(path, Path(container, "Installs/Linux/External/Product"))
+                elif "Linux64_xclang_Installs.tar.gz" == t:
+                    ExtractArchive(path, Path(container, "Installs/Linux/External/Product"), 2)
+                else:
+                    ExtractArchive(path, Path(container))
+
+    with Phase("clone"):
+        RunParallel(CloneHelpers, containers, args.clone_jobs)
+
+    RecordPhases(events[first:])
+    for container in containers:
+        RecordArtifacts(container, [Path(container, t) for t, url in artifacts[container]])
+
+#
+# Return the git repos of a container: its own repo and all its submodules (recursively)
+#
+def GitRepos(container):
+    repoDir = RepoDir(container)
+    if not os.path.exists(os.path.join(repoDir, ".git")):
+        return []
+    repos = [repoDir]
+    for line in CmdOutput(["git", "submodule", "status", "--recursive"], repoDir).splitlines():
+        # " <sha1> <path> (<describe>)", prefixed - if not initialised
+        if line.startswith("-"):
+            continue
+        path = line[1:].split()[1]
+        repos.append(os.path.join(repoDir, path))
+    return repos
+
+#
+# Run "cmd" in a git repo, and get the repo's status for the --git summary
+#
+def GitRun(repo, cmd):
+    if not cmd.startswith("git ") and "git" != cmd:
+        cmd = "git " + cmd
+    result = {"repo" : os.path.relpath(repo, Path()), "cmd" : cmd, "branch" : "", "tracking" : "",
+              "changes" : 0, "ahead" : 0, "behind" : 0}
 
+    if args.dryrun:
+        Log("Running cmd: %s in %s" % (cmd, repo))
+        result["status"] = 0
+        result["output"] = ""
+    else:
+        with Phase("git", repo, cmd):
+            p = subprocess.Popen(cmd, shell=True, cwd=repo, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            result["output"] = p.communicate()[0]
+            result["status"] = p.returncode
+
+    # "## branch...remote/branch [ahead 1, behind 2]" then a line per changed file
+    lines = CmdOutput(["git", "status", "--porcelain", "-b"], repo).splitlines()
+    if lines and lines[0].startswith("## "):
+        m = re.match(r"## (\S+?)(?:\.\.\.(\S+))?(?: \[(.*)\])?$", lines[0])
+        if m:
+            result["branch"] = m.group(1)
+            result["tracking"] = m.group(2) or ""
+            for part in (m.group(3) or "").split(", "):
+                if part.startswith("ahead "):
+                    result["ahead"] = int(part.split()[1])
+                elif part.startswith("behind "):
+                    result["behind"] = int(part.split()[1])
+        lines = lines[1:]
+    result["changes"] = len(lines)
+    result["state"] = lines and "dirty" or "clean"
+    return result
+
+#
+# Run a git command in every repo and submodule of "containers" at once, then print
+# the output of each and a summary of their states. With --git-json the results are
+# also written to a file (or - for stdout) for use by scripts.
+#
+def Git(containers, cmd):
+    with Phase("git"):
+        repos = sum(RunParallel(GitRepos, containers, args.git_jobs), [])
+        results = RunParallel(lambda r: GitRun(r, cmd), repos, args.git_jobs)
+
+    if "-" == args.git_json:
+        json.dump(results, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+        return [r["repo"] for r in results if r["status"]]
+
+    for r in results:
+        if r["output"].strip():
+            Log("==== %s: %s\n%s" % (r["repo"], r["cmd"], r["output"].rstrip()))
+
+    width = max([len(r["repo"]) for r in results] + [4])
+    Log("%-*s  %-20s  %-6s  %5s  %6s  %4s" % (width, "Repo", "Branch", "State", "Ahead", "Behind", "Exit"))
+    for r in results:
+        Log("%-*s  %-20s  %-6s  %5d  %6d  %4d" % (width, r["repo"], r["branch"], r["state"], r["ahead"], r["behind"], r["status"]))
+    Log("%d repos: %d dirty, %d ahead, %d behind, %d failed" % (len(results),
+        len([r for r in results if "dirty" == r["state"]]),
+        len([r for r in results if r["ahead"]]),
+        len([r for r in results if r["behind"]]),
+        len([r for r in results if r["status"]])))
+
+    if args.git_json:
+        with open(args.git_json + ".tmp", "w") as f:
+            json.dump(results, f, indent=1)
+        os.rename(args.git_json + ".tmp", args.git_json)
+
+    return [r["repo"] for r in results if r["status"]]
 
-for c in containers_todo:
-    if args.clone:
-        Unpack(c, args.update)
-    elif args.git:
-        Git(c, args.git)
+#
+# Split a "container:domain,domain" command line spec into the container and domains
+#
+def SplitSpec(spec):
+    parts = spec.split(":")
+    repo = parts[0]
+    if len(parts) > 1:
+        domains = parts[1]
     else:
-        parts = c.split(":")
-        repo = parts[0]
-        if len(parts) > 1:
-            domains = parts[1]
+        domains = ""
+    return repo, domains
+
+#
+# Return all the containers (from those in "specs") which depend on "repo", directly or otherwise
+#
+def Dependents(repo, specs):
+    found = []
+    for c in TopoSort(specs):
+        if c in found:
+            continue
+        deps = all_containers[c]
+        if repo in deps or [d for d in found if d in deps]:
+            found.append(c)
+    return found
+
+#
+# Check that all_containers lists every container after the containers it depends on,
+# and that every dependency is a container which exports tarballs
+#
+def ValidateContainers():
+    errors = []
+    seen = []
+    for c, deps in all_containers.items():
+        for d in deps:
+            if d not in all_containers:
+                errors.append("%s depends on unknown container %s" % (c, d))
+            elif d not in seen:
+                errors.append("%s depends on %s which is listed after it in all_containers" % (c, d))
+            if d not in container_exports:
+                errors.append("%s depends on %s which has no container_exports entry" % (c, d))
+            if list(deps).count(d) > 1:
+                errors.append("%s lists %s more than once" % (c, d))
+        seen.append(c)
+
+    for c in container_exports:
+        if c not in all_containers:
+            errors.append("container_exports has %s which is not in all_containers" % (c,))
+
+    if errors:
+        raise Exception("Invalid container dependencies:\n  " + "\n  ".join(sorted(set(errors))))
+
+#
+# Return "containers" in dependency order (parents first), keeping the all_containers
+# order for containers which do not depend on each other
+#
+def TopoSort(containers):
+    todo = [c for c in all_containers if c in containers]
+    done = []
+    while todo:
+        ready = [c for c in todo if not [d for d in all_containers[c] if d in todo]]
+        if not ready:
+            raise Exception("Dependency cycle between %s" % (", ".join(todo),))
+        done += ready
+        todo = [c for c in todo if c not in ready]
+    return done
+
+#
+# Return the containers whose tarballs are imported into a container, in dependency order
+# so a container's tarballs are extracted after those of the containers it rebuilt files of
+#
+def Imports(container):
+    return TopoSort(set(all_containers[container]))
+
+#
+# Source state recorded at each successful build, used to find the containers changed since
+#
+def SourceState(container):
+    h = hashlib.sha1()
+    HashTreeState(h, RepoDir(container))
+    return h.hexdigest()
+
+def SaveSourceState(container, state):
+    with open(Path(container, ".build_tools_source"), "w") as f:
+        f.write(state + "\n")
+
+#
+# Return the cloned containers whose sources have changed since they were last built
+#
+def ChangedContainers():
+    changed = []
+    for c in all_containers:
+        if not os.path.isdir(RepoDir(c) + "/.git") and not os.path.isfile(RepoDir(c) + "/.git"):
+            continue
+        try:
+            with open(Path(c, ".build_tools_source")) as f:
+                previous = f.read().strip()
+        except IOError:
+            previous = None
+        if previous != SourceState(c):
+            changed.append(c)
+    return changed
+
+#
+# Return the containers which must be rebuilt after "containers" have changed: those
+# containers plus every container in the working area depending on them (directly
+# or otherwise), in dependency order
+#
+def Affected(containers):
+    affected = set(containers)
+    for c in containers:
+        affected |= set([d for d in Dependents(c, all_containers) if os.path.isdir(Path(d))])
+    return TopoSort(affected)
+
+#
+# GNU make jobserver (--make-jobs), so all the Build.pl runs share one budget of
+# parallel jobs rather than each make/ninja picking its own.
+#
+# Each session (see Session) creates a pipe holding one token per job (less the
+# one each make gets implicitly), whose fds are passed to the child build_tools.py
+# processes of BuildParallel in the environment. The build scripts export them in
+# MAKEFLAGS, and the parallel scheduler also takes a token for each container it
+# runs beyond the first.
+#
+def StartJobserver(jobs):
+    r, w = os.pipe()
+    os.write(w, "+" * (jobs - 1))
+    return [r, w, jobs]
+
+#
+# The [read fd, write fd, jobs] of the current session's jobserver, or None
+#
+def Jobserver():
+    return CurrentSession().jobserver
+
+makeVersion = None
+
+#
+# The MAKEFLAGS for a make to use the jobserver
+#
+def JobserverMakeflags():
+    global makeVersion
+    r, w, jobs = Jobserver()
+    if makeVersion is None:
+        makeVersion = (0, 0)
+        if FindProgram("make"):
+            m = re.search(r"GNU Make (\d+)\.(\d+)", CmdOutput(["make", "--version"]))
+            if m:
+                makeVersion = (int(m.group(1)), int(m.group(2)))
+    # make 4.2 renamed --jobserver-fds
+    if makeVersion >= (4, 2):
+        return "-j%d --jobserver-auth=%d,%d" % (jobs, r, w)
+    return "-j%d --jobserver-fds=%d,%d" % (jobs, r, w)
+
+#
+# Take a token from the jobserver without waiting, returns whether one was free
+#
+def TakeToken():
+    session = CurrentSession()
+    if session.jobserverReader is None:
+        # A separate non-blocking open of the pipe, so the makes reading it still block
+        session.jobserverReader = os.open("/proc/self/fd/%d" % (Jobserver()[0],), os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        return 1 == len(os.read(session.jobserverReader, 1))
+    except OSError, e:
+        if errno.EAGAIN != e.errno:
+            raise
+        return False
+
+def ReturnToken():
+    os.write(Jobserver()[1], "+")
+
+def ContainerMemory(repo):
+    return container_memory.get(repo, default_container_memory)
+
+#
+# Build the containers in "todo" in dependency order, one at a time in this process
+#
+def BuildSerial(todo, keepGoing):
+    specs = collections.OrderedDict([SplitSpec(c) for c in todo])
+    failed = []
+    skipped = []
+
+    for repo, domains in specs.items():
+        if repo in skipped:
+            print "Build: skipping %s as a container it depends on failed" % (repo,)
+            continue
+
+        events = CurrentSession().timingEvents
+        first = len(events)
+        try:
+            try:
+                with Phase("build", repo):
+                    Build(repo, domains, Imports(repo), args.debugbuild, args.reimport)
+            finally:
+                if not args.reimport:
+                    RecordPhases([e for e in events[first:] if e["container"] == repo], domains)
+        except Exception, e:
+            if not keepGoing:
+                raise
+            print "Build: %s FAILED: %s" % (repo, e)
+            failed.append(repo)
+            skipped += Dependents(repo, specs)
+
+    return failed, skipped
+
+#
+# Build the containers in "todo" as a dependency graph, running up to "jobs" at once.
+#
+# Each container is built by a child build_tools.py process so that its output
+# (including that of Build.pl) is written to <logdir>/<container>.log.
+# A container is started once all the containers it depends on which are also
+# being built have completed. On a failure either stop (killing the running
+# builds) or, with keepGoing, carry on with everything not dependent on it.
+#
+def BuildParallel(todo, jobs, keepGoing, logdir):
+    specs = collections.OrderedDict([SplitSpec(c) for c in todo])
+
+    # Start the containers with the longest estimated time to the end of the build first
+    priorities = BuildPriorities(specs, EstimateBuilds(todo))
+    waiting = collections.OrderedDict()
+    for repo in sorted(specs, key=lambda r: -priorities[r]):
+        waiting[repo] = set([d for d in all_containers[repo] if d in specs])
+
+    if not os.path.isdir(logdir):
+        os.makedirs(logdir)
+
+    running = {}
+    failed = []
+    skipped = []
+    tokens = 0
+
+    while waiting or running:
+        # Start any containers which have nothing left to wait for
+        for repo in list(waiting):
+            if len(running) >= jobs or (failed and not keepGoing):
+                break
+            if waiting[repo]:
+                continue
+            if running and args.memory_limit and \
+               sum([ContainerMemory(r) for r in running]) + ContainerMemory(repo) > args.memory_limit:
+                # Wait for memory, but a smaller container may still fit
+                continue
+            if running and Jobserver():
+                if not TakeToken():
+                    break
+                tokens += 1
+            del waiting[repo]
+
+            spec = repo
+            if specs[repo]:
+                spec = "%s:%s" % (repo, specs[repo])
+
+            logName = os.path.join(logdir, "%s.log" % (repo,))
+            log = open(logName, "w")
+            argv = ChildArgs(spec, ("jobs", "keep_going", "mkroot", "clone", "affected_by", "watch"))
+            print "Schedule: starting %s (log %s)" % (repo, logName)
+
+            kwargs = {}
+            if "posix" == os.name:
+                # Own process group so the whole Build.pl tree can be stopped
+                kwargs["preexec_fn"] = os.setsid
+            # Unbuffered so the log interleaves our prints and the command output correctly
+            env = dict(os.environ)
+            env["PYTHONUNBUFFERED"] = "1"
+            env["BUILD_TOOLS_CHILD"] = "1"
+            if Jobserver():
+                env["BUILD_TOOLS_JOBSERVER"] = "%d,%d,%d" % tuple(Jobserver())
+            handle = subprocess.Popen(argv, cwd=os.path.dirname(Path()), env=env, stdout=log, stderr=subprocess.STDOUT, **kwargs)
+            running[repo] = (handle, log, time.time())
+
+        if not running:
+            # Either everything is done or nothing more can be started
+            break
+
+        time.sleep(0.2)
+
+        for repo, (handle, log, start) in list(running.items()):
+            r = handle.poll()
+            if r is None:
+                continue
+            del running[repo]
+            log.close()
+            if tokens > max(0, len(running) - 1):
+                ReturnToken()
+                tokens -= 1
+
+            if 0 == r:
+                print "Schedule: %s completed in %ds" % (repo, time.time() - start)
+                for w in waiting.values():
+                    w.discard(repo)
+                continue
+
+            print "Schedule: %s FAILED (%s), see %s" % (repo, r, os.path.join(logdir, "%s.log" % (repo,)))
+            failed.append(repo)
+
+            if keepGoing:
+                for d in Dependents(repo, specs):
+                    if d in waiting:
+                        del waiting[d]
+                        skipped.append(d)
+            else:
+                for other, (h, l, s) in running.items():
+                    print "Schedule: stopping %s" % (other,)
+                    if "posix" == os.name:
+                        os.killpg(h.pid, signal.SIGTERM)
+                    else:
+                        h.terminate()
+
+    skipped += list(waiting)
+    return failed, skipped
+
+#
+# --watch: rebuild containers as their sources change.
+#
+# The container repos are watched with inotify (or by polling their mtimes where
+# inotify is not available). Once the changes stop for --watch-delay seconds each
+# changed path is mapped to its container and domain, ignoring files git ignores
+# and those outside the domains built (see build_domains). The changed containers
+# and all those depending on them are then rebuilt with --incremental, so only the
+# changed domains (and those depending on them) are passed to Build.pl. The build
+# runs in this process so the parsed Jenkinsfiles, file hashes and overlay
+# manifests are kept in memory between rebuilds.
+#
+watchIgnore = [".git", "infr_scripts_pl", "tools_bin2header", "Installs*", ".build_tools*",
+               "*.tgz", "*.tar.gz", "*.zip", "*.meta", "*.part", "*.tmp*", "*.swp", "*~", "4913"]
+
+def WatchIgnored(name):
+    return [p for p in watchIgnore if fnmatch.fnmatch(name, p)]
+
+#
+# The directories to watch under "top"
+#
+def WatchDirs(top):
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames[:] = [d for d in dirnames if not WatchIgnored(d)]
+        yield dirpath
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_CLOEXEC     = 0x00080000
+
+#
+# Watch directory trees with inotify (through libc, as python 2 has no binding)
+#
+class InotifyWatcher(object):
+    mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, tops):
+        import ctypes, ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        self.warned = False
+        for top in tops:
+            self.Add(top)
+
+    def Add(self, top):
+        for d in WatchDirs(top):
+            wd = self.libc.inotify_add_watch(self.fd, d, self.mask)
+            if wd < 0:
+                if not self.warned:
+                    print "Watch: cannot watch %s (too many directories? see /proc/sys/fs/inotify/max_user_watches)" % (d,)
+                    self.warned = True
+                continue
+            self.dirs[wd] = d
+
+    #
+    # Return the paths changed within "timeout" seconds (None to wait for a change),
+    # and whether events were lost
+    #
+    def Read(self, timeout):
+        import select
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return [], False
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip("\0")
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            if wd not in self.dirs or WatchIgnored(name):
+                continue
+            path = os.path.join(self.dirs[wd], name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.Add(path)
+            paths.append(path)
+        return paths, overflow
+
+#
+# Watch directory trees by comparing the mtimes of their files once a second
+#
+class PollWatcher(object):
+    def __init__(self, tops):
+        self.tops = tops
+        self.state = self.Scan()
+
+    def Scan(self):
+        state = {}
+        for top in self.tops:
+            for d in WatchDirs(top):
+                for n in os.listdir(d):
+                    if WatchIgnored(n):
+                        continue
+                    try:
+                        st = os.lstat(os.path.join(d, n))
+                    except OSError:
+                        continue
+                    if not stat.S_ISDIR(st.st_mode):
+                        state[os.path.join(d, n)] = (st.st_size, st.st_mtime)
+        return state
+
+    def Read(self, timeout):
+        end = timeout is not None and time.time() + timeout
+        while True:
+            time.sleep(1)
+            state = self.Scan()
+            paths = [p for p in set(state) | set(self.state) if state.get(p) != self.state.get(p)]
+            self.state = state
+            if paths or (end and time.time() >= end):
+                return paths, False
+
+#
+# Return the paths (from "paths") git ignores
+#
+def GitIgnored(paths):
+    top = Path()
+    repos = collections.defaultdict(list)
+    for p in paths:
+        # Only look for the repos within the working area
+        d = os.path.dirname(p)
+        while d.startswith(top + os.sep) and not os.path.exists(os.path.join(d, ".git")):
+            d = os.path.dirname(d)
+        if d.startswith(top + os.sep):
+            repos[d].append(os.path.relpath(p, d))
+
+    ignored = set()
+    for repo, rels in repos.items():
+        proc = subprocess.Popen(["git", "check-ignore", "--stdin", "-z"], cwd=repo,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out = proc.communicate("\0".join(rels) + "\0")[0]
+        ignored |= set([os.path.join(repo, r) for r in out.split("\0") if r])
+    return ignored
+
+#
+# Return the container and domain a changed path (relative to working) belongs to,
+# with a domain of None for a change elsewhere in the container, or None if the
+# change does not affect the build
+#
+def WatchTarget(path):
+    parts = path.split(os.sep)
+    container = parts[0]
+    if container not in all_containers or len(parts) < 2:
+        return None
+    sub = parts[1]
+
+    repoDir = RepoDir(container)
+    if repoDir != Path(container):
+        # A flat structure container: only the repo in the domain subdir is source
+        if sub == os.path.basename(repoDir):
+            return container, sub
+        return None
+
+    if build_domains.has_key(container):
+        if sub in build_domains[container].split(","):
+            return container, sub
+        return None
+
+    if sub in ignoreDomains:
+        return None
+    if os.path.exists(Path(container, sub, "Build.pl")):
+        return container, sub
+    return container, None
+
+def Watch(containers):
+    args.incremental = True
+    watched = [c for c in containers if os.path.isdir(Path(c))]
+    try:
+        watcher = InotifyWatcher([Path(c) for c in watched])
+    except (OSError, AttributeError), e:
+        print "Watch: inotify is not available (%s), polling for changes" % (e,)
+        watcher = PollWatcher([Path(c) for c in watched])
+    print "Watch: watching %s (Ctrl-C to stop)" % (" ".join(watched),)
+
+    pending = set()
+    overflow = False
+    try:
+        while True:
+            # Wait for a change, then until there have been none for --watch-delay
+            paths, lost = watcher.Read(pending and args.watch_delay or None)
+            if paths or lost:
+                pending |= set(paths)
+                overflow = overflow or lost
+                continue
+
+            changed = collections.OrderedDict()
+            if overflow:
+                print "Watch: too many changes to follow, checking all containers"
+                for c in watched:
+                    changed[c] = set([None])
+            paths = pending - GitIgnored(pending)
+            pending = set()
+            overflow = False
+            for p in sorted(paths):
+                target = WatchTarget(os.path.relpath(p, Path()))
+                if target:
+                    changed.setdefault(target[0], set()).add(target[1])
+            if not changed:
+                continue
+
+            print "Watch: changed %s" % (", ".join(["%s (%s)" % (c, ", ".join(sorted([d or "-" for d in domains])))
+                                                   for c, domains in changed.items()]),)
+            todo = Affected(list(changed))
+            start = time.time()
+            if args.jobs > 1:
+                failed, skipped = BuildParallel(todo, args.jobs, True, args.logdir)
+            else:
+                failed, skipped = BuildSerial(todo, True)
+            if failed:
+                print "Watch: FAILED %s%s" % (" ".join(failed), skipped and ", not built %s" % (" ".join(skipped),) or "")
+            else:
+                print "Watch: built %s in %ds" % (" ".join(todo), time.time() - start)
+            print "Watch: watching for changes"
+    except KeyboardInterrupt:
+        print "Watch: stopped"
+
+#
+# The command line: a thin wrapper over a Session
+#
+def Main(argv=None):
+    options = ParseArgs(sys.argv[1:] if argv is None else argv)
+    if options.serve_cache:
+        ServeSharedCache(options.serve_cache, options.serve_address, options.serve_port, options.shared_cache_size)
+        return 0
+
+    session = Session(options=options)
+    with session:
+        if args.clone and args.mkroot:
+            os.mkdir(session.working)
+            os.mkdir(Path("exports"))
+
+        if args.timing:
+            if not os.environ.get("BUILD_TOOLS_CHILD"):
+                # Start a new set of events for this run
+                shutil.rmtree(os.path.join(args.timing, "events"), True)
+            atexit.register(session.WriteTiming)
+
+        if args.show_deps:
+            for c in all_containers:
+                print "%-22s imports %s" % (c, ", ".join(Imports(c)) or "-")
+            return 0
+
+        if args.affected_by is not None:
+            # Rebuild the given containers (or those changed since they were last built) and
+            # everything depending on them
+            changed = args.affected_by
+            if not changed:
+                changed = ChangedContainers()
+                print "Changed since last built: %s" % (" ".join(changed) or "none",)
+            for c in changed:
+                if c not in all_containers:
+                    print "Invalid container %s" % (c,)
+                    return 1
+            args.containers += [c for c in Affected(changed) if c not in [SplitSpec(a)[0] for a in args.containers]]
+            print "Affected containers: %s" % (" ".join([SplitSpec(a)[0] for a in args.containers]),)
+            if not args.containers:
+                return 0
+
+        try:
+            containers_todo = session.Todo(args.containers)
+        except Exception, e:
+            print e
+            return 1
+
+        if args.clone:
+            session.Clone(containers_todo, args.update, args.from_area)
+        elif args.watch:
+            session.Watch(containers_todo)
+        elif args.git:
+            if session.Git(args.git, containers_todo):
+                return 1
+        elif args.plan:
+            session.Plan(containers_todo)
         else:
-            domains = ""
+            failed, skipped = session.Build(containers_todo, args.jobs, args.keep_going)
 
-        deps = all_containers[repo]
+            if skipped:
+                print "Not built: %s" % (" ".join(skipped),)
+            if failed:
+                print "Failed: %s" % (" ".join(failed),)
+                return 1
+    return 0
 
-        Build(repo, domains, deps, args.debugbuild, args.reimport)
+if __name__ == "__main__":
+    sys.exit(Main())
 
 #
 # Example commands
@@ -558,6 +3867,9 @@ for c in containers_todo:
 #  # Make a new "working" subdir and clone the tools_common container repo
 #  python ~/bin/build_tools.py --mkroot --clone  tools_common 
 #
+#  # Make a second working area, for a parallel change, from the one in ~/tools
+#  python ~/bin/build_tools.py --mkroot --clone --from ~/tools
+#
 #  # Update the tools_common container repo to pick up rebuilt Jenkins components (e.g. xc_compiler_combined)
 #  python ~/bin/build_tools.py --clone --update tools_common 
 #
@@ -568,6 +3880,42 @@ for c in containers_todo:
 #
 #  # Build a subset of repos within container repos
 #  python ~/bin/build_tools.py tools_common:infr_libs_cpp xmap xgdb_combined xflash:tools_xflash tools_installers:tools_installers
+#
+#  # Build all, up to 4 containers at once, carrying on past failures (logs in working/logs)
+#  python ~/bin/build_tools.py -j 4 --keep-going
+#
+#  # Build all with one budget of 16 make jobs between them, and at most 32GB of builds at once
+#  python ~/bin/build_tools.py -j 4 --make-jobs 16 --memory-limit 32
+#
+#  # Rebuild xas and every container which imports it (directly or otherwise)
+#  python ~/bin/build_tools.py --affected-by xas
+#
+#  # Rebuild the containers changed since they were last built, and everything depending on them
+#  python ~/bin/build_tools.py --affected-by
+#
+#  # Rebuild xas (and everything depending on it) whenever its sources are edited
+#  python ~/bin/build_tools.py --watch xas xmap xobjdump
+#
+#  # Show the estimated time of building everything 4 at once (from previous builds) and its critical path
+#  python ~/bin/build_tools.py -j 4 --plan
+#
+#  # Fetch every repo and submodule (8 at once), then show which are dirty/ahead/behind
+#  python ~/bin/build_tools.py --git fetch
+#  python ~/bin/build_tools.py --git "status -s" --git-json status.json
+#
+#  # Build in another working area (the default is ./working)
+#  python ~/bin/build_tools.py --working ~/tools2/working xas
+#
+#  # From python, build in two working areas at once (importing build_tools.py runs nothing)
+#  import build_tools, threading
+#  for w in ("/home/me/tools/working", "/home/me/tools2/working"):
+#      threading.Thread(target=build_tools.Session(w, jobs=2).Build, args=(["xas"],)).start()
+#
+#  # Serve a team build cache (on a trusted network: uploads are not authenticated), and build
+#  # using it (fetching builds others have done, pushing ours)
+#  python ~/bin/build_tools.py --serve-cache /data/build_cache --serve-address 0.0.0.0 --serve-port 8050
+#  python ~/bin/build_tools.py -j 4 --shared-cache http://buildcache:8050
+#  python ~/bin/build_tools.py --shared-cache /nfs/build_cache --shared-cache-size 200
 
 # Build all
 # ./build_tools.py xcommon tools_common ar tools_xpp xc_compiler_combined xas xmap xobjdump xsim_combined xgdb_combined xcc_driver tools_libs_combined \